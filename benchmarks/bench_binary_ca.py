@@ -0,0 +1,56 @@
+r"""
+Benchmark of the binary coded aperture inference path.
+
+Compares the CASSI operators with float32 coded apertures against the same layers after
+:meth:`colibri.optics.utils.BaseOpticsLayer.binarize`, which stores the coded aperture as a
+boolean mask that is cast to the dtype of the scene for the products. The memory
+of the coded aperture is reported for both paths.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_binary_ca.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics import SD_CASSI, DD_CASSI, C_CASSI
+
+
+def measure(layer, x, type_calculation):
+    timer = Timer(stmt="layer(x, type_calculation=type_calculation)", setup="torch.set_grad_enabled(False)",
+                  globals={"layer": layer, "x": x, "type_calculation": type_calculation, "torch": torch})
+    return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+def nbytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"{'layer':<10}{'operator':<10}{'B':>4}{'L':>5}{'M=N':>6}{'float [ms]':>12}{'binary [ms]':>13}{'speedup':>9}{'float CA [MB]':>15}{'binary CA [MB]':>16}")
+
+    for layer_cls in [SD_CASSI, DD_CASSI, C_CASSI]:
+        for B, L, M in [(1, 31, 256), (4, 31, 256), (1, 31, 512)]:
+            layer = layer_cls((L, M, M))
+            binary = layer_cls((L, M, M))
+            binary.learnable_optics.data.copy_(layer.learnable_optics.data)
+            binary.binarize()
+            layer.learnable_optics.data = (layer.learnable_optics.data > 0).float()
+
+            x = torch.randn(B, L, M, M)
+            with torch.no_grad():
+                y = layer(x)
+                # The float and boolean apertures round differently in float32
+                assert torch.allclose(binary(x), y, atol=1e-5)
+
+            for name, inputs in [("forward", x), ("backward", y)]:
+                t_float = measure(layer, inputs, name)
+                t_binary = measure(binary, inputs, name)
+                print(f"{layer_cls.__name__:<10}{name:<10}{B:>4}{L:>5}{M:>6}{t_float:>12.2f}{t_binary:>13.2f}{t_float / t_binary:>8.2f}x"
+                      f"{nbytes(layer.learnable_optics) / 2**20:>15.2f}{nbytes(binary.learnable_optics) / 2**20:>16.2f}")
@@ -0,0 +1,69 @@
+r"""
+Throughput of the eager, compiled and scripted optics operators.
+
+The forward, adjoint and Gram operators of SD-CASSI, DD-CASSI, C-CASSI and SPC are timed
+in eager mode, compiled with ``torch.compile`` (CPU inductor) and, for the forward and
+adjoint operators, with their functional operators scripted with ``torch.jit.script``.
+The operators run without gradients, as in the iterations of a reconstruction, and the
+compiled operators are warmed up before timing so the compilation time is not measured.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_compile.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics.cassi import SD_CASSI, DD_CASSI, C_CASSI
+from colibri.optics.spc import SPC
+from colibri.optics.functional import adjoint_spc
+
+
+def measure(fn, x):
+    with torch.no_grad():
+        fn(x)  # Warm up, the first call of a compiled operator compiles it
+        timer = Timer(stmt="fn(x)", globals={"fn": fn, "x": x})
+        return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+def scripted_operators(layer):
+    sensing = torch.jit.script(layer.sensing)
+    adjoint = torch.jit.script(adjoint_spc if isinstance(layer, SPC) else layer.adjoint)
+    optics = layer.learnable_optics.detach()
+    if isinstance(layer, SPC):
+        image_size = (layer.M, layer.N)
+        return lambda x: sensing(x, optics), lambda y: adjoint(y, optics, image_size)
+    return lambda x: sensing(x, optics), lambda y: adjoint(y, optics)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    B, L, M = 8, 31, 128
+    x = torch.rand(B, L, M, M)
+    print(f"{'layer':<10}{'operator':<10}{'eager [ms]':>12}{'compiled [ms]':>15}{'scripted [ms]':>15}")
+
+    layers = [
+        ("SD_CASSI", SD_CASSI((L, M, M))),
+        ("DD_CASSI", DD_CASSI((L, M, M))),
+        ("C_CASSI", C_CASSI((L, M, M))),
+        ("SPC", SPC((L, M, M), n_measurements=1024, backward_method="transpose")),
+    ]
+    for name, layer in layers:
+        with torch.no_grad():
+            y = layer.forward_operator(x)
+        script_forward, script_adjoint = scripted_operators(layer)
+        operators = [
+            ("forward", layer.forward_operator, x, script_forward),
+            ("adjoint", layer.adjoint_operator, y, script_adjoint),
+            ("gram", layer.gram, x, None),
+        ]
+        for operator, fn, inputs, scripted in operators:
+            eager = measure(fn, inputs)
+            compiled = measure(torch.compile(fn), inputs)
+            script = float("nan") if scripted is None else measure(scripted, inputs)
+            print(f"{name:<10}{operator:<10}{eager:>12.2f}{compiled:>15.2f}{script:>15.2f}")
@@ -0,0 +1,101 @@
+r"""
+Iterations of FISTA needed to reach a target PSNR with adaptive restart and backtracking.
+
+A smooth synthetic cube is measured with SD-CASSI, DD-CASSI, C-CASSI and SPC and recovered
+in the DCT domain with the plain iterations, the gradient and function restart schemes,
+backtracking from a step ten times larger than 1/L, and restart with backtracking. All the
+solvers solve the same problem, the threshold of the backtracking runs is scaled with their
+initial step, so the PSNR is measured against the solution of that problem, computed with
+many iterations of the gradient restart scheme. The PSNR against the cube is bounded by the
+compression of the layer and would not be reached by every solver. The iterations are
+deterministic, so the PSNR after k iterations is read by running k iterations for k in a
+grid, each run with a new acquisition model and solver so the runs do not share
+a Lipschitz estimate, and the first k of the grid where the PSNR reaches the target is
+reported.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_fista_convergence.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from colibri.optics import SD_CASSI, DD_CASSI, C_CASSI, SPC
+from colibri.recovery.fista import Fista
+from colibri.recovery.terms.fidelity import L2
+from colibri.recovery.terms.prior import Sparsity
+from colibri.recovery.transforms import DCT2D
+
+
+def psnr(x, reference):
+    mse = torch.mean((x - reference) ** 2)
+    return (10 * torch.log10(reference.abs().max() ** 2 / mse)).item()
+
+
+def smooth_cube(B, L, M, N):
+    u = torch.linspace(0, 1, M).view(1, 1, M, 1)
+    v = torch.linspace(0, 1, N).view(1, 1, 1, N)
+    w = torch.linspace(0, 1, L).view(1, L, 1, 1)
+    phases = torch.rand(B, 3, 1, 1, 1) * 6.28
+    return 0.5 + 0.5 * torch.sin(4 * u + phases[:, 0]) * torch.cos(3 * v + phases[:, 1]) * torch.cos(2 * w + phases[:, 2])
+
+
+def seeded(layer_cls, *args, **kwargs):
+    # Every acquisition model of a layer is built with the same random optics
+    def make_layer():
+        torch.manual_seed(1)
+        return layer_cls(*args, **kwargs)
+    return make_layer
+
+
+def reconstruct(make_layer, y, x0, params, max_iter):
+    algo_params = dict(params, max_iter=max_iter, tol=None)
+    fista = Fista(L2(), Sparsity(), make_layer(), algo_params, DCT2D())
+    return fista(y, x0=x0)
+
+
+def iterations_to_target(make_layer, y, x0, solution, params, target, grid):
+    for max_iter in grid:
+        if psnr(reconstruct(make_layer, y, x0, params, max_iter), solution) >= target:
+            return max_iter
+    return None
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    B, L, M = 2, 16, 32
+    target = 50.0
+    grid = [20, 40, 80, 120, 160, 240, 320, 480, 640]
+    x = smooth_cube(B, L, M, M)
+    x0 = torch.zeros_like(x)
+
+    layers = [
+        ("SD_CASSI", seeded(SD_CASSI, (L, M, M))),
+        ("DD_CASSI", seeded(DD_CASSI, (L, M, M))),
+        ("C_CASSI", seeded(C_CASSI, (L, M, M))),
+        ("SPC", seeded(SPC, (L, M, M), n_measurements=M * M // 2)),
+    ]
+    print(f"target PSNR {target} dB against the solution, iterations of the grid {grid}")
+    print(f"{'layer':<10}{'plain':>8}{'gradient':>10}{'function':>10}{'backtrack':>11}{'both':>8}")
+    for name, make_layer in layers:
+        acquisition_model = make_layer()
+        with torch.no_grad():
+            y = acquisition_model(x)
+        alpha = 1 / acquisition_model.operator_norm(DCT2D()) ** 2
+        _lambda = 1e-3
+        configs = [
+            {"alpha": alpha, "lambda": _lambda},
+            {"alpha": alpha, "lambda": _lambda, "restart": "gradient"},
+            {"alpha": alpha, "lambda": _lambda, "restart": "function"},
+            # "lambda" is the threshold at the step "alpha", it is scaled with the step to solve the same problem
+            {"alpha": 10 * alpha, "lambda": 10 * _lambda, "backtracking": True},
+            {"alpha": 10 * alpha, "lambda": 10 * _lambda, "backtracking": True, "restart": "gradient"},
+        ]
+        solution = reconstruct(make_layer, y, x0, configs[1], 8 * grid[-1])
+        counts = [iterations_to_target(make_layer, y, x0, solution, params, target, grid) for params in configs]
+        counts = [f">{grid[-1]}" if n is None else str(n) for n in counts]
+        print(f"{name:<10}{counts[0]:>8}{counts[1]:>10}{counts[2]:>10}{counts[3]:>11}{counts[4]:>8}")
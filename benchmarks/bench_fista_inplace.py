@@ -0,0 +1,60 @@
+r"""
+Allocator pressure and wall-clock time of the FISTA iterations with and without the low-allocation mode.
+
+A 512x512x31 SD-CASSI measurement is recovered in the DCT domain for a fixed number of
+iterations, with the default iterations and with ``algo_params["inplace"] = True``. The
+allocations are counted from the memory events of the profiler, and the remaining ones
+per iteration are those of the forward and adjoint operators and the DCT.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_fista_inplace.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from colibri.optics import SD_CASSI
+from colibri.recovery.fista import Fista
+from colibri.recovery.terms.fidelity import L2
+from colibri.recovery.terms.prior import Sparsity
+from colibri.recovery.transforms import DCT2D
+
+
+def allocations(fn):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.cpu_memory_usage for e in prof.events() if e.name == "[memory]" and e.cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)
+
+
+def measure(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    B, L, M, N = 1, 31, 512, 512
+    n_iter = 20
+    acquisition_model = SD_CASSI((L, M, N))
+    y = acquisition_model(torch.rand(B, L, M, N)).detach()
+    x0 = torch.zeros(B, L, M, N)
+
+    print(f"{'mode':<10}{'allocations/iter':>18}{'MB/iter':>10}{'time/iter [ms]':>16}")
+    for mode, inplace in [("default", False), ("inplace", True)]:
+        algo_params = {"max_iter": n_iter, "lambda": 1e-3, "tol": None, "inplace": inplace}
+        fista = Fista(L2(), Sparsity(), acquisition_model, algo_params, DCT2D())
+        fista(y, x0=x0)  # Caches the step size
+        count, size = allocations(lambda: fista(y, x0=x0))
+        t = measure(lambda: fista(y, x0=x0))
+        print(f"{mode:<10}{count / n_iter:>18.1f}{size / n_iter / 2**20:>10.1f}{t / n_iter * 1e3:>16.1f}")
@@ -0,0 +1,78 @@
+r"""
+Accuracy and speed of the reduced precision optics operators.
+
+The SD-CASSI and SPC forward operators are evaluated with float32, bfloat16 and float16
+cubes and optics. The half precision operators accumulate their reductions in float32;
+their relative error against float64 is reported next to the error of a naive operator
+that accumulates in half precision, adding the bands, or the products of the image rows,
+one at a time into a half precision sum. The CPU time and the memory of the cube are also
+reported.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_precision.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics.functional import forward_sd_cassi, forward_spc, prism_operator
+
+
+def forward_sd_cassi_naive(x, ca):
+    # The sum over the bands of the CPU kernels accumulates in float32, so the bands are added one by one
+    bands = prism_operator(x * ca, shift_sign=1).unbind(dim=1)
+    y = torch.zeros_like(bands[0])
+    for band in bands:
+        y = y + band
+    return y.unsqueeze(1)
+
+
+def forward_spc_naive(x, H):
+    # The matrix products of the CPU kernels accumulate in float32, so the products of the image rows are added one by one
+    B, L, M, N = x.shape
+    x = x.reshape(B, L, M, N).permute(0, 2, 3, 1)
+    H = H.unflatten(-1, (M, N))
+    y = x.new_zeros(B, H.shape[0], L)
+    for m in range(M):
+        y = y + torch.matmul(H[:, m], x[:, m])
+    return y
+
+
+def relative_error(y, reference):
+    return (torch.linalg.norm(y.double() - reference) / torch.linalg.norm(reference)).item()
+
+
+def measure(fn, *args):
+    timer = Timer(stmt="fn(*args)", globals={"fn": fn, "args": args})
+    return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"{'operator':<18}{'dtype':<10}{'B':>4}{'L':>5}{'M=N':>6}{'error':>11}{'naive error':>13}{'time [ms]':>11}{'cube [MB]':>11}")
+
+    cases = [
+        ("forward_sd_cassi", forward_sd_cassi, forward_sd_cassi_naive, lambda L, M: torch.rand(1, 1, M, M), [(4, 64, 256)]),
+        ("forward_spc", forward_spc, forward_spc_naive, lambda L, M: torch.rand(512, M * M), [(4, 64, 64)]),
+    ]
+    for name, operator, naive, optics, sizes in cases:
+        for B, L, M in sizes:
+            x = torch.rand(B, L, M, M)
+            ca = optics(L, M)
+            reference = operator(x.double(), ca.double())
+
+            for dtype in [torch.float32, torch.bfloat16, torch.float16]:
+                x_low, ca_low = x.to(dtype), ca.to(dtype)
+                error = relative_error(operator(x_low, ca_low), reference)
+                try:
+                    naive_error = relative_error(naive(x_low, ca_low), reference)
+                except RuntimeError:
+                    naive_error = float("nan")  # Not implemented for this dtype on CPU
+                t = measure(operator, x_low, ca_low)
+                mbytes = x_low.numel() * x_low.element_size() / 2**20
+                print(f"{name:<18}{str(dtype).split('.')[-1]:<10}{B:>4}{L:>5}{M:>6}{error:>11.2e}{naive_error:>13.2e}{t:>11.2f}{mbytes:>11.1f}")
@@ -0,0 +1,69 @@
+r"""
+Benchmark of the CASSI dispersion engine.
+
+Compares the strided-view :func:`colibri.optics.functional.prism_operator` against the
+previous implementation, which padded or sliced every band in a Python loop and stacked
+the result, for both shift directions and for the SD-CASSI operators built on top of it.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_prism_operator.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics.functional import prism_operator, forward_sd_cassi, backward_sd_cassi
+
+
+def prism_operator_loop(x, shift_sign=1):
+    _, L, M, N = x.shape
+    x = torch.unbind(x, dim=1)
+    if shift_sign == 1:
+        x = [torch.nn.functional.pad(x[l], (l, L - l - 1)) for l in range(L)]
+    else:
+        x = [x[l][:, :, l:N - (L - 1) + l] for l in range(L)]
+    return torch.stack(x, dim=1)
+
+
+def forward_sd_cassi_loop(x, ca):
+    return prism_operator_loop(torch.multiply(x, ca), 1).sum(dim=1, keepdim=True)
+
+
+def backward_sd_cassi_loop(y, ca):
+    L = y.shape[-1] - ca.shape[-1] + 1
+    y = torch.tile(y, [1, L, 1, 1])
+    return torch.multiply(prism_operator_loop(y, -1), ca)
+
+
+def measure(fn, *args):
+    timer = Timer(stmt="fn(*args)", globals={"fn": fn, "args": args})
+    return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"{'operator':<24}{'B':>4}{'L':>5}{'M=N':>6}{'loop [ms]':>12}{'view [ms]':>12}{'speedup':>9}")
+
+    for B, L, M in [(1, 31, 256), (1, 31, 512), (1, 64, 512), (4, 31, 256)]:
+        x = torch.randn(B, L, M, M)
+        ca = torch.randn(1, 1, M, M)
+        y = forward_sd_cassi(x, ca)
+        x_dispersed = prism_operator(x, 1).contiguous()
+
+        cases = [
+            ("prism_operator(+1)", prism_operator_loop, prism_operator, (x, 1)),
+            ("prism_operator(-1)", prism_operator_loop, lambda x, s: prism_operator(x, s).contiguous(), (x_dispersed, -1)),
+            ("forward_sd_cassi", forward_sd_cassi_loop, forward_sd_cassi, (x, ca)),
+            ("backward_sd_cassi", backward_sd_cassi_loop, backward_sd_cassi, (y, ca)),
+        ]
+        for name, reference, fast, args in cases:
+            # The strided operators sum the bands in another order, so they agree up to float32 rounding
+            assert torch.allclose(reference(*args), fast(*args), rtol=1e-5, atol=1e-5), name
+            t_loop = measure(reference, *args)
+            t_view = measure(fast, *args)
+            print(f"{name:<24}{B:>4}{L:>5}{M:>6}{t_loop:>12.2f}{t_view:>12.2f}{t_loop / t_view:>8.1f}x")
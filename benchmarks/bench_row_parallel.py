@@ -0,0 +1,49 @@
+r"""
+Scaling benchmark of the row-parallel CASSI operators.
+
+Times :meth:`colibri.optics.BaseOpticsLayer.parallel` with an increasing number of worker
+processes, up to the number of available cores, and reports the speedup and the parallel
+efficiency with respect to the single process operator. The pool start-up is included in
+the timings, as it is paid on every call.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_row_parallel.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+
+from colibri.optics import SD_CASSI, DD_CASSI, C_CASSI
+
+
+def measure(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    B, L, M, N = 1, 31, 1024, 1024
+    x = torch.rand(B, L, M, N)
+    cores = os.cpu_count()
+    workers = [w for w in [1, 2, 4, 8, 16, 32, 64] if w < cores] + [cores]
+
+    for layer in [SD_CASSI((L, M, N)), DD_CASSI((L, M, N)), C_CASSI((L, M, N))]:
+        with torch.no_grad():
+            y = layer(x)
+            for type_calculation, inputs in [("forward", x), ("backward", y)]:
+                t_serial = measure(lambda: layer(inputs, type_calculation=type_calculation))
+                print(f"{type(layer).__name__} {type_calculation}: single process {t_serial * 1e3:.1f} ms")
+                print(f"{'workers':>10}{'time [ms]':>12}{'speedup':>10}{'efficiency':>12}")
+                for w in workers:
+                    t = measure(lambda: layer.parallel(inputs, type_calculation=type_calculation, num_workers=w))
+                    print(f"{w:>10}{t * 1e3:>12.1f}{t_serial / t:>10.2f}{t_serial / t / w:>12.2f}")
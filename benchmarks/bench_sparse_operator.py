@@ -0,0 +1,68 @@
+r"""
+Benchmark of the sparse matrix export of the optics layers.
+
+Reports the time to build the CSR matrices of SD-CASSI and SPC with
+:meth:`colibri.optics.utils.BaseOpticsLayer.to_sparse`, and compares the forward and
+adjoint operators of the layers, computed with the dense strided kernels, against
+products with the exported matrices on CPU. The export is meant for preconditioners and
+external solvers, the products are slower than the operators of the layers.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_sparse_operator.py
+"""
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics import SD_CASSI, SPC
+
+
+def measure(fn, *args):
+    timer = Timer(stmt="fn(*args)", globals={"fn": fn, "args": args})
+    return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+def apply_dense(layer, x, type_calculation):
+    with torch.no_grad():
+        return layer(x, type_calculation=type_calculation)
+
+
+def apply_sparse(layer, x, type_calculation):
+    transpose = type_calculation == "backward"
+    shape = layer.input_shape if transpose else layer.measurement_shape
+    B = x.shape[0]
+    return torch.matmul(layer.to_sparse(transpose), x.reshape(B, -1).t()).t().reshape(B, *shape)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"{'layer':<10}{'operator':<10}{'B':>4}{'L':>5}{'M=N':>6}{'build [ms]':>12}{'dense [ms]':>12}{'sparse [ms]':>13}{'speedup':>9}")
+
+    layers = [
+        (SD_CASSI, dict(), [(1, 31, 128), (8, 31, 128), (1, 31, 256)]),
+        (SPC, dict(n_measurements=64, backward_method="transpose"), [(1, 3, 32), (8, 3, 32)]),
+    ]
+    for layer_cls, kwargs, sizes in layers:
+        for B, L, M in sizes:
+            layer = layer_cls((L, M, M), **kwargs)
+            x = torch.randn(B, L, M, M)
+            y = apply_dense(layer, x, "forward")
+
+            start = time.perf_counter()
+            layer.to_sparse()
+            layer.to_sparse(transpose=True)
+            t_build = (time.perf_counter() - start) * 1e3
+
+            for name, inputs in [("forward", x), ("backward", y)]:
+                dense = apply_dense(layer, inputs, name)
+                # The products sum in another order, the tolerance is relative to the magnitude of the outputs, which is large for SPC
+                assert torch.allclose(apply_sparse(layer, inputs, name), dense, rtol=1e-5, atol=1e-5 * dense.abs().max().item()), name
+                t_dense = measure(apply_dense, layer, inputs, name)
+                t_sparse = measure(apply_sparse, layer, inputs, name)
+                print(f"{layer_cls.__name__:<10}{name:<10}{B:>4}{L:>5}{M:>6}{t_build:>12.2f}{t_dense:>12.2f}{t_sparse:>13.2f}{t_dense / t_sparse:>8.1f}x")
@@ -0,0 +1,60 @@
+r"""
+Throughput benchmark of the Single Pixel Camera (SPC) sensing model.
+
+Compares :func:`colibri.optics.functional.forward_spc`, which broadcasts the measurement
+matrix over the batch, against the previous implementation that repeated the matrix once
+per sample before a batched product. Channels last inputs and a reused output buffer are
+also timed. The repeated reference is skipped when its copies of the matrix would not fit
+in the memory budget.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_spc.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics.functional import forward_spc
+
+
+def forward_spc_repeat(x, H):
+    B, L, M, N = x.size()
+    x = x.contiguous().view(B, L, M * N).permute(0, 2, 1)
+    H = H.unsqueeze(0).repeat(B, 1, 1)
+    return torch.bmm(H, x)
+
+
+def measure(fn, *args, **kwargs):
+    timer = Timer(stmt="fn(*args, **kwargs)", globals={"fn": fn, "args": args, "kwargs": kwargs})
+    return timer.blocked_autorange(min_run_time=1.0).median
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    L = 3
+    memory_budget = 2 * 2**30  # Bytes of the copies of H made by the repeated reference
+    print(f"{'B':>4}{'S':>7}{'M=N':>6}{'repeat [img/s]':>17}{'broadcast [img/s]':>20}{'channels last':>16}{'out buffer':>13}")
+
+    for B in [1, 16, 64]:
+        for S in [256, 1024, 4096]:
+            for M in [32, 64, 128]:
+                if S > M * M:
+                    continue
+                x = torch.randn(B, L, M, M)
+                x_cl = x.to(memory_format=torch.channels_last)
+                H = torch.randn(S, M * M)
+                out = torch.empty(B, S, L)
+
+                repeated_size = B * H.numel() * H.element_size()
+                throughput = [
+                    B / measure(forward_spc_repeat, x, H) if repeated_size <= memory_budget else float("nan"),
+                    B / measure(forward_spc, x, H),
+                    B / measure(forward_spc, x_cl, H),
+                    B / measure(forward_spc, x, H, out=out),
+                ]
+                print(f"{B:>4}{S:>7}{M:>6}{throughput[0]:>17.1f}{throughput[1]:>20.1f}{throughput[2]:>16.1f}{throughput[3]:>13.1f}")
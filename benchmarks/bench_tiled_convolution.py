@@ -0,0 +1,55 @@
+r"""
+Benchmark of the PSF convolution engines.
+
+Compares a direct grouped :func:`torch.nn.functional.conv2d`, a single full-size FFT
+(:func:`colibri.optics.functional.forward_doe`) and the overlap-add tiled FFT
+(:func:`colibri.optics.functional.tiled_convolution`) for large PSFs, and reports the
+number of elements of the largest FFT of each engine.
+
+Run from the root of the repository::
+
+    python benchmarks/bench_tiled_convolution.py
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from torch.utils.benchmark import Timer
+
+from colibri.optics.functional import psf_spectrum_doe, forward_doe, tiled_convolution
+
+
+def conv2d_same(x, psf):
+    Mh, Nh = psf.shape[-2:]
+    kernel = psf.permute(1, 0, 2, 3).flip(-2, -1)
+    x = torch.nn.functional.pad(x, (Nh - 1 - Nh // 2, Nh // 2, Mh - 1 - Mh // 2, Mh // 2))
+    return torch.nn.functional.conv2d(x, kernel, groups=x.shape[1])
+
+
+def measure(fn, *args):
+    timer = Timer(stmt="fn(*args)", globals={"fn": fn, "args": args})
+    return timer.blocked_autorange(min_run_time=1.0).median * 1e3
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    print(f"{'L':>4}{'M=N':>6}{'PSF':>5}{'tile':>6}{'conv2d [ms]':>13}{'full FFT [ms]':>15}{'tiled [ms]':>12}{'full FFT size':>15}{'tile FFT size':>15}")
+
+    for L, M, K, T, direct in [(3, 512, 64, 128, True), (3, 1024, 128, 256, False), (3, 2048, 128, 256, False)]:
+        x = torch.randn(1, L, M, M)
+        psf = torch.rand(1, L, K, K)
+        psf = psf / psf.sum(dim=(-2, -1), keepdim=True)
+        full = psf_spectrum_doe(psf, (M, M))
+        tiled = psf_spectrum_doe(psf, (T, T))
+
+        reference = forward_doe(x, full, (K, K))
+        assert torch.allclose(tiled_convolution(x, tiled, (K, K), (T, T)), reference, atol=1e-4)
+
+        t_direct = measure(conv2d_same, x, psf) if direct else float("nan")
+        t_full = measure(forward_doe, x, full, (K, K))
+        t_tiled = measure(tiled_convolution, x, tiled, (K, K), (T, T))
+        full_size = L * (M + K - 1) ** 2
+        tile_size = L * (M // T) * (T + K - 1) ** 2
+        print(f"{L:>4}{M:>6}{K:>5}{T:>6}{t_direct:>13.2f}{t_full:>15.2f}{t_tiled:>12.2f}{full_size:>15}{tile_size:>15}")
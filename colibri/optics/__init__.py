@@ -1,3 +1,4 @@
-from .cassi import C_CASSI, DD_CASSI, SD_CASSI
+from .cassi import C_CASSI, DD_CASSI, SD_CASSI, MultiShotCASSI
 from .utils import BaseOpticsLayer
-from .spc import SPC
\ No newline at end of file
+from .spc import SPC, HadamardSPC, SeparableSPC, BlockSPC
+from .doe import DOE
\ No newline at end of file
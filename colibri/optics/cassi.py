@@ -1,5 +1,8 @@
 import torch
 from colibri.optics.functional import forward_color_cassi, backward_color_cassi, forward_dd_cassi, backward_dd_cassi, forward_sd_cassi, backward_sd_cassi
+from colibri.optics.functional import optics_grad_color_cassi, optics_grad_dd_cassi, optics_grad_sd_cassi
+from colibri.optics.functional import multishot_apertures, forward_multishot_cassi, backward_multishot_cassi
+from colibri.optics.functional import sparse_sd_cassi, sparse_dd_cassi, sparse_color_cassi
 from .utils import BaseOpticsLayer
 
     
@@ -28,14 +31,19 @@ class SD_CASSI(BaseOpticsLayer):
 
     """
 
-    def __init__(self, input_shape, trainable=False, initial_ca=None, **kwargs):
+    row_separable = True
+    optics_ndim = 3
+    binary_optics = True
+
+    def __init__(self, input_shape, trainable=False, initial_ca=None, n_apertures=1, **kwargs):
         r"""
         Initializes the SD_CASSI layer.
 
         Args:
             input_shape (tuple): Tuple, shape of the input image (L, M, N).
             trainable (bool): Boolean, if True the coded aperture is trainable
-            initial_ca (torch.Tensor): Initial coded aperture with shape (1, 1, M, N)
+            initial_ca (torch.Tensor): Initial coded aperture with shape (1, 1, M, N), or a batch of K coded apertures with shape (K, 1, M, N)
+            n_apertures (int): Number K of random coded apertures if initial_ca is None. Each one measures every sample, so a batch of B samples produces K*B measurements grouped by coded aperture.
         """
         
         self.trainable = trainable
@@ -43,18 +51,20 @@ class SD_CASSI(BaseOpticsLayer):
 
 
         self.L, self.M, self.N = input_shape  # Extract spectral image shape
+        self.input_shape = tuple(input_shape)
+        self.measurement_shape = (1, self.M, self.N + self.L - 1)
 
-        shape = (1, 1, self.M, self.N)
+        shape = (n_apertures, 1, self.M, self.N)
         if self.initial_ca is None:
             initializer = torch.randn(shape, requires_grad=self.trainable) 
         else:
-            assert self.initial_ca.shape == shape, f"the start CA shape should be {shape} but is {self.initial_ca.shape}"
+            assert self.initial_ca.shape[1:] == shape[1:], f"the start CA shape should be {('K',) + shape[1:]} but is {self.initial_ca.shape}"
             initializer = torch.from_numpy(self.initial_ca).float()
 
         #Add parameter CA in pytorch manner
         ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
 
-        super(SD_CASSI, self).__init__(learnable_optics=ca, sensing=forward_sd_cassi, backward=backward_sd_cassi)
+        super(SD_CASSI, self).__init__(learnable_optics=ca, sensing=forward_sd_cassi, backward=backward_sd_cassi, optics_grad=optics_grad_sd_cassi)
 
     def forward(self, x, type_calculation="forward"):
         r"""
@@ -71,6 +81,9 @@ class SD_CASSI(BaseOpticsLayer):
 
         return super(SD_CASSI, self).forward(x, type_calculation)
 
+    def _sparse_matrix(self, ca):
+        return sparse_sd_cassi(ca, self.L)
+
 class DD_CASSI(BaseOpticsLayer):
     r"""
     
@@ -95,32 +108,39 @@ class DD_CASSI(BaseOpticsLayer):
     The dual dispersion of the scene :math:`\mathbf{x}` is achieved by two prisms, and mathematically can be represented as a single dispersion to the coded aperture:math:`\learnedOptics \in \{0,1\}^{M \times N + L-1}`. 
     """
 
-    def __init__(self, input_shape, trainable=False, initial_ca=None, **kwargs):
+    row_separable = True
+    optics_ndim = 3
+    binary_optics = True
+
+    def __init__(self, input_shape, trainable=False, initial_ca=None, n_apertures=1, **kwargs):
         r"""
         Initializes the DD_CASSI layer.
 
         Args:
             input_shape (tuple): Tuple, shape of the input image (L, M, N).
             trainable (bool): Boolean, if True the coded aperture is trainable
-            initial_ca (torch.Tensor): Initial coded aperture with shape (1, 1, M, N + L - 1)
+            initial_ca (torch.Tensor): Initial coded aperture with shape (1, 1, M, N + L - 1), or a batch of K coded apertures with shape (K, 1, M, N + L - 1)
+            n_apertures (int): Number K of random coded apertures if initial_ca is None. Each one measures every sample, so a batch of B samples produces K*B measurements grouped by coded aperture.
         """
         self.trainable = trainable
         self.initial_ca = initial_ca
 
 
         self.L, self.M, self.N = input_shape  # Extract spectral image shape
+        self.input_shape = tuple(input_shape)
+        self.measurement_shape = (1, self.M, self.N)
 
-        shape = (1, 1, self.M, self.N + self.L - 1)
+        shape = (n_apertures, 1, self.M, self.N + self.L - 1)
 
         if self.initial_ca is None:
             initializer = torch.randn(shape, requires_grad=self.trainable)
         else:
-            assert self.initial_ca.shape == shape, f"the start CA shape should be {shape} but is {self.initial_ca.shape}"
+            assert self.initial_ca.shape[1:] == shape[1:], f"the start CA shape should be {('K',) + shape[1:]} but is {self.initial_ca.shape}"
             initializer = torch.from_numpy(self.initial_ca).float()
 
         #Add parameter CA in pytorch manner
         ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
-        super(DD_CASSI, self).__init__(learnable_optics=ca, sensing=forward_dd_cassi, backward=backward_dd_cassi)
+        super(DD_CASSI, self).__init__(learnable_optics=ca, sensing=forward_dd_cassi, backward=backward_dd_cassi, optics_grad=optics_grad_dd_cassi)
 
 
     def forward(self, x, type_calculation="forward"):
@@ -138,6 +158,9 @@ class DD_CASSI(BaseOpticsLayer):
 
         return super(DD_CASSI, self).forward(x, type_calculation)
 
+    def _sparse_matrix(self, ca):
+        return sparse_dd_cassi(ca, self.L)
+
 
 class C_CASSI(BaseOpticsLayer):
     r"""
@@ -165,32 +188,39 @@ class C_CASSI(BaseOpticsLayer):
 
     """
 
-    def __init__(self, input_shape, trainable=False, initial_ca=None, **kwargs):
+    row_separable = True
+    optics_ndim = 3
+    binary_optics = True
+
+    def __init__(self, input_shape, trainable=False, initial_ca=None, n_apertures=1, **kwargs):
         r"""
         Initializes the C_CASSI layer.
 
         Args:
             input_shape (tuple): Tuple, shape of the input image (L, M, N).
             trainable (bool): Boolean, if True the coded aperture is trainable
-            initial_ca (torch.Tensor): Initial coded aperture with shape (1, L, M, N)
+            initial_ca (torch.Tensor): Initial coded aperture with shape (1, L, M, N), or a batch of K coded apertures with shape (K, L, M, N)
+            n_apertures (int): Number K of random coded apertures if initial_ca is None. Each one measures every sample, so a batch of B samples produces K*B measurements grouped by coded aperture.
         """
         self.trainable = trainable
         self.initial_ca = initial_ca
 
 
         self.L, self.M, self.N = input_shape  # Extract spectral image shape
+        self.input_shape = tuple(input_shape)
+        self.measurement_shape = (1, self.M, self.N + self.L - 1)
 
-        shape = (1, self.L, self.M, self.N)
+        shape = (n_apertures, self.L, self.M, self.N)
 
         if self.initial_ca is None:
             initializer = torch.randn(shape, requires_grad=self.trainable)
         else:
-            assert self.initial_ca.shape == shape, f"the start CA shape should be {shape} but is {self.initial_ca.shape}"
+            assert self.initial_ca.shape[1:] == shape[1:], f"the start CA shape should be {('K',) + shape[1:]} but is {self.initial_ca.shape}"
             initializer = torch.from_numpy(self.initial_ca).float()
 
         #Add parameter CA in pytorch manner
         ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
-        super(C_CASSI, self).__init__(learnable_optics=ca, sensing=forward_color_cassi, backward=backward_color_cassi)
+        super(C_CASSI, self).__init__(learnable_optics=ca, sensing=forward_color_cassi, backward=backward_color_cassi, optics_grad=optics_grad_color_cassi)
 
     def forward(self, x, type_calculation="forward"):
         r"""
@@ -207,4 +237,90 @@ class C_CASSI(BaseOpticsLayer):
 
         return super(C_CASSI, self).forward(x, type_calculation)
 
+    def _sparse_matrix(self, ca):
+        return sparse_color_cassi(ca)
+
         
+
+
+class MultiShotCASSI(BaseOpticsLayer):
+    r"""
+
+    Multi-shot Coded Aperture Snapshot Spectral Imager
+
+    Several snapshots of the same scene are acquired with K different coded apertures, which improves the conditioning of the sensing matrix. 
+    Any of the SD-CASSI, DD-CASSI or C-CASSI architectures can be used, and the measurements are stacked as channels
+
+    .. math::
+
+        \mathbf{y}_k = \forwardLinear_{\learnedOptics_k}(\mathbf{x}) + \noise, \quad k = 1, \dots, K
+
+    The backward operator is the adjoint of the stacked system, :math:`\sum_{k=1}^{K} \forwardLinear_{\learnedOptics_k}^\top(\mathbf{y}_k)`. 
+    The scene is dispersed once for all the shots and the dispersed apertures are cached until they change, so the K snapshots and the summed adjoint are each computed in a single contraction.
+
+    """
+
+    row_separable = True
+
+    def __init__(self, input_shape, n_shots=2, mode="sd", trainable=False, initial_ca=None, **kwargs):
+        r"""
+        Initializes the MultiShotCASSI layer.
+
+        Args:
+            input_shape (tuple): Tuple, shape of the input image (L, M, N).
+            n_shots (int): Number K of snapshots.
+            mode (str): String, CASSI architecture, it can be "sd", "dd" or "color".
+            trainable (bool): Boolean, if True the coded apertures are trainable
+            initial_ca (torch.Tensor): Initial coded apertures with shape (K, 1, M, N) for "sd", (K, 1, M, N + L - 1) for "dd" or (K, L, M, N) for "color"
+        Raises:
+            ValueError: If mode is not "sd", "dd" or "color"
+        """
+        self.trainable = trainable
+        self.initial_ca = initial_ca
+        self.mode = mode
+
+        self.L, self.M, self.N = input_shape  # Extract spectral image shape
+        self.input_shape = tuple(input_shape)
+
+        if mode == "sd":
+            shape = (n_shots, 1, self.M, self.N)
+        elif mode == "dd":
+            shape = (n_shots, 1, self.M, self.N + self.L - 1)
+        elif mode == "color":
+            shape = (n_shots, self.L, self.M, self.N)
+        else:
+            raise ValueError("mode must be sd, dd or color")
+
+        if self.initial_ca is None:
+            initializer = torch.randn(shape, requires_grad=self.trainable)
+        else:
+            assert self.initial_ca.shape[1:] == shape[1:], f"the start CA shape should be {('K',) + shape[1:]} but is {self.initial_ca.shape}"
+            initializer = torch.from_numpy(self.initial_ca).float()
+
+        #Add parameter CA in pytorch manner
+        ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
+        super(MultiShotCASSI, self).__init__(learnable_optics=ca, sensing=self._sensing, backward=self._adjoint)
+
+    def forward(self, x, type_calculation="forward"):
+        r"""
+        Call method of the layer, it performs the forward or backward operator according to the type_calculation
+
+        Args:
+            x (torch.Tensor): Input tensor with shape (B, L, M, N)
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+        Returns:
+            torch.Tensor: Measurements with shape (B, K, M, N + L - 1) (or (B, K, M, N) for "dd") if type_calculation is "forward", (B, L, M, N) if type_calculation is "backward" or "forward_backward"
+        Raises:
+            ValueError: If type_calculation is not "forward", "backward" or "forward_backward"
+        """
+
+        return super(MultiShotCASSI, self).forward(x, type_calculation)
+
+    def _apertures(self, ca):
+        return self.cached("apertures", lambda ca: multishot_apertures(ca, self.L, self.mode).contiguous(), ca)
+
+    def _sensing(self, x, ca):
+        return forward_multishot_cassi(x, self._apertures(ca), self.mode)
+
+    def _adjoint(self, y, ca):
+        return backward_multishot_cassi(y, self._apertures(ca), self.mode)
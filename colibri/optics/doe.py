@@ -0,0 +1,123 @@
+import torch
+from colibri.optics.functional import transfer_function_doe, psf_doe, psf_spectrum_doe, forward_doe, backward_doe, tiled_convolution, tiled_correlation
+from .utils import BaseOpticsLayer
+
+
+class DOE(BaseOpticsLayer):
+    r"""
+    Diffractive Optical Element (DOE)
+
+    A DOE is a thin phase plate whose height map shapes the point spread function (PSF) of the imaging system, so the scene is acquired as the convolution of each spectral band with the PSF of its wavelength.
+
+    Mathematically, the system is described as follows.
+
+    .. math::
+
+        \mathbf{y} = \forwardLinear_{\learnedOptics}(\mathbf{x}) + \noise
+
+    where :math:`\noise` is the sensor noise, :math:`\mathbf{x}\in\xset` is the input optical field, :math:`\mathbf{y}\in\yset` are the acquired signal, for the DOE, :math:`\xset = \mathbb{R}^{L \times M \times N}` and :math:`\yset = \mathbb{R}^{L \times M \times N}`, and :math:`\forwardLinear_{\learnedOptics}:\xset\rightarrow \yset` is the convolution with the PSFs
+
+    .. math::
+        \begin{align*}
+        \forwardLinear_{\learnedOptics}: \mathbf{x} &\mapsto \mathbf{y} \\
+                        \mathbf{y}_{l} &=  \mathbf{h}_{\lambda_l}(\learnedOptics) * \mathbf{x}_{l}
+        \end{align*}
+
+    with :math:`\learnedOptics` the height map and :math:`\mathbf{h}_{\lambda}(\learnedOptics)` the intensity of a plane wave of wavelength :math:`\lambda` after the DOE, propagated to the sensor with the angular spectrum method.
+
+    The transfer functions of the propagation only depend on the geometry and are precomputed, and the spectrum of the PSFs is cached until the height map changes.
+    For large images, the convolutions can be computed in tiles with overlap-add, which bounds the size of the FFTs.
+
+    """
+
+    def __init__(self, input_shape, wavelengths, pixel_size=1e-6, distance=50e-3, refractive_index=1.5, height_map_shape=None, trainable=False, initial_height_map=None, tile_size=None, **kwargs):
+        r"""
+        Initializes the DOE layer.
+
+        Args:
+            input_shape (tuple): Tuple, shape of the input image (L, M, N).
+            wavelengths (list): Wavelength of each of the L bands, in meters.
+            pixel_size (float): Sampling period of the DOE and the sensor, in meters.
+            distance (float): Distance from the DOE to the sensor, in meters.
+            refractive_index (float): Refractive index of the DOE material.
+            height_map_shape (tuple): Size (Mh, Nh) of the height map and the PSFs, if None it is (M, N).
+            trainable (bool): Boolean, if True the height map is trainable
+            initial_height_map (torch.Tensor): Initial height map with shape (Mh, Nh), in meters, if None it is random with up to one wave of phase delay.
+            tile_size (int or tuple): Size (T_m, T_n) of the tiles of the overlap-add convolution, if None the whole image is convolved with a single FFT.
+        """
+        self.trainable = trainable
+        self.initial_height_map = initial_height_map
+        self.refractive_index = refractive_index
+
+        self.L, self.M, self.N = input_shape  # Extract spectral image shape
+        self.input_shape = tuple(input_shape)
+        self.measurement_shape = tuple(input_shape)
+        self.psf_size = (self.M, self.N) if height_map_shape is None else tuple(height_map_shape)
+        self.tile_size = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+
+        wavelengths = torch.as_tensor(wavelengths, dtype=torch.float32)
+        assert wavelengths.numel() == self.L, f"there should be {self.L} wavelengths but there are {wavelengths.numel()}"
+
+        if self.initial_height_map is None:
+            max_height = wavelengths.max() / (refractive_index - 1)
+            initializer = torch.rand(self.psf_size) * max_height
+        else:
+            assert tuple(self.initial_height_map.shape) == self.psf_size, f"the height map shape should be {self.psf_size} but is {self.initial_height_map.shape}"
+            initializer = torch.as_tensor(self.initial_height_map).float()
+
+        #Add parameter height map in pytorch manner
+        height_map = torch.nn.Parameter(initializer, requires_grad=self.trainable)
+        super(DOE, self).__init__(learnable_optics=height_map, sensing=self._sensing, backward=self._adjoint)
+
+        # Circular aperture inscribed in the DOE
+        Mh, Nh = self.psf_size
+        u = torch.arange(Mh) - Mh // 2
+        v = torch.arange(Nh) - Nh // 2
+        u, v = torch.meshgrid(u, v, indexing="ij")
+        aperture = ((u / (Mh / 2)) ** 2 + (v / (Nh / 2)) ** 2 <= 1).float()
+
+        self.register_buffer("wavelengths", wavelengths)
+        self.register_buffer("aperture", aperture)
+        self.register_buffer("transfer_function", transfer_function_doe(wavelengths, self.psf_size, pixel_size, distance))
+
+    def forward(self, x, type_calculation="forward"):
+        r"""
+        Call method of the layer, it performs the forward or backward operator according to the type_calculation
+
+        Args:
+            x (torch.Tensor): Input tensor with shape (B, L, M, N)
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+        Returns:
+            torch.Tensor: Output tensor with shape (B, L, M, N)
+        Raises:
+            ValueError: If type_calculation is not "forward", "backward" or "forward_backward"
+        """
+
+        return super(DOE, self).forward(x, type_calculation)
+
+    def get_psf(self, height_map=None):
+        r"""
+        Computes the PSFs of the DOE.
+
+        Args:
+            height_map (torch.Tensor): Height map with shape (Mh, Nh), if None the learnable height map is used.
+        Returns:
+            torch.Tensor: PSFs with shape (1, L, Mh, Nh)
+        """
+        height_map = self.learnable_optics if height_map is None else height_map
+        return psf_doe(height_map, self.wavelengths, self.transfer_function, self.aperture, self.refractive_index)
+
+    def _spectrum(self, height_map):
+        # The spectrum depends on the FFT size, it is cached for each tile size
+        size = (self.M, self.N) if self.tile_size is None else tuple(self.tile_size)
+        return self.cached(f"psf_spectrum_{size}", lambda height_map: psf_spectrum_doe(self.get_psf(height_map), size), height_map)
+
+    def _sensing(self, x, height_map):
+        if self.tile_size is None:
+            return forward_doe(x, self._spectrum(height_map), self.psf_size)
+        return tiled_convolution(x, self._spectrum(height_map), self.psf_size, self.tile_size)
+
+    def _adjoint(self, y, height_map):
+        if self.tile_size is None:
+            return backward_doe(y, self._spectrum(height_map), self.psf_size)
+        return tiled_correlation(y, self._spectrum(height_map), self.psf_size, self.tile_size)
@@ -1,11 +1,96 @@
 import torch
 import numpy as np
+from typing import Optional, Tuple
 
-def prism_operator(x, shift_sign = 1):
+def _dispersion_view(x, L: int, width: int, step: int):
+    r"""
+
+    Zero-copy strided view of the L spectral shifts of x along the column axis.
+
+    Args:
+        x (torch.Tensor): Input tensor with shape (B, L, M, N) or (B, 1, M, N), a single-band tensor is shared by all the shifts
+        L (int): Number of spectral bands of the view
+        width (int): Number of columns of the view
+        step (int): Column shift between consecutive bands
+    Returns:
+        torch.Tensor: View with shape (B, L, M, width) such that view[b, l, m, j] = x[b, l, m, j + step * l]
+
+    """
+    B, C, M, _ = x.shape
+    stride_b, stride_c, stride_m, stride_n = x.stride()
+    # The band stride of a single band is never used, a single-channel tensor dispersed to the left cannot be viewed
+    band_stride = (stride_c if C > 1 else 0) + step * stride_n if L > 1 else 0
+    assert band_stride >= 0, "a single-channel tensor can only be dispersed with a non-negative step"
+    # The storage offset of x is kept without being read, torch.compile breaks the graph on it
+    return x.as_strided([B, L, M, width], [stride_b, band_stride, stride_m, stride_n])
+
+
+def accumulation_dtype(dtype: torch.dtype) -> torch.dtype:
+    r"""
+
+    Dtype in which the operators accumulate their reductions, e.g. the sum over the bands of CASSI. 
+    The matrix products of SPC are computed in half precision, their kernels already accumulate in float32, so the matrices are not copied to float32.
+
+    Half precision tensors (float16 and bfloat16) are accumulated in float32 and the results are stored back in half precision, other dtypes are accumulated in their own precision.
+
+    Args:
+        dtype (torch.dtype): Dtype of the inputs.
+    Returns:
+        torch.dtype: Dtype of the accumulation.
+    """
+    return torch.float32 if dtype == torch.float16 or dtype == torch.bfloat16 else dtype
+
+
+def _binary_to(ca, dtype: torch.dtype):
+    r"""
+
+    Casts a boolean coded aperture to dtype through bytes, which is several times faster than casting the booleans directly, other apertures are returned as they are.
+
+    """
+    return ca.to(torch.uint8).to(dtype) if ca.dtype == torch.bool else ca
+
+
+def _code(x, ca, per_sample: bool = False):
+    r"""
+
+    Multiplies x by a batch of K coded apertures stacked along the first dimension of ca.
+
+    Args:
+        x (torch.Tensor): Input tensor with shape (B, ...), or (K*B, ...) if per_sample is True
+        ca (torch.Tensor): Coded apertures with shape (K, ...), boolean apertures are applied as masks
+        per_sample (bool): If False, every sample of x is coded by each aperture, otherwise the samples of x are grouped by aperture and each one is coded by its own aperture
+    Returns:
+        torch.Tensor: Coded tensor with shape (K*B, ...), the samples are grouped by aperture
+
+    """
+    K = ca.shape[0]
+    if K > 1:
+        x = x.unflatten(0, [K, -1]) if per_sample else x.unsqueeze(0)
+        ca = ca.unsqueeze(1)
+    # A boolean aperture is cast before the product, promoting it in the product or selecting the entries is slower
+    y = torch.multiply(x, _binary_to(ca, x.dtype))
+    return y if K == 1 else y.flatten(0, 1)
+
+
+def _correlate(x, y, K):
+    r"""
+
+    Sums x * y over the samples coded by each of the K apertures, x has shape (B, ...) and y has shape (K*B, ...), the result has shape (K, ...) or (B, ...) if K is 1.
+
+    """
+    if K == 1:
+        return torch.multiply(x, y)
+    return torch.multiply(x.unsqueeze(0), y.unflatten(0, (K, -1))).sum(dim=1)
+
+
+def prism_operator(x, shift_sign: int = 1):
     r"""
 
     Prism operator, shifts linearly the input tensor x in the spectral dimension.
 
+    All the bands are shifted at once by reading a strided view of the input, so no per-band copies are made.
+    The output is a view and should not be modified in place.
+
     Args:
         x (torch.Tensor): Input tensor with shape (B, L, M, N)
         shift_sign (int): Integer, it can be 1 or -1, it indicates the direction of the shift
@@ -18,18 +103,15 @@ def prism_operator(x, shift_sign = 1):
     assert shift_sign == 1 or shift_sign == -1, "The shift sign must be 1 or -1"
     _, L, M, N = x.shape  # Extract spectral image shape
 
-    x = torch.unbind(x, dim=1)
-
-
     if shift_sign == 1:
-        # Shifting produced by the prism 
-        x = [torch.nn.functional.pad(x[l], (l, L - l - 1)) for l in range(L)]
+        # Shifting produced by the prism, the rows are padded with L zeros and read as one sequence per
+        # batch, band l starts l columns before its first row, so its first l columns read the zeros padded to the row above
+        R = N + L
+        x = torch.nn.functional.pad(x, [0, L]).flatten(1)[:, :L * (M * R - 1)]
+        return x.unflatten(1, [L, M * R - 1]).unfold(-1, N + L - 1, R)
     else:
         # Unshifting produced by the prism
-        x = [x[l][:, :, l:N - (L- 1)+l] for l in range(L)]
-
-    x = torch.stack(x, dim=1)
-    return x
+        return _dispersion_view(x, L, N - L + 1, step=1)
 
 def forward_color_cassi(x, ca):
 
@@ -41,14 +123,14 @@ def forward_color_cassi(x, ca):
 
     Args:
         x (torch.Tensor): Spectral image with shape (B, L, M, N)
-        ca (torch.Tensor): Coded aperture with shape (1, L, M, N)
+        ca (torch.Tensor): Coded aperture with shape (1, L, M, N), or a batch of K coded apertures with shape (K, L, M, N)
     
     Returns: 
-        torch.Tensor: Measurement with shape (B, 1, M, N + L - 1)
+        torch.Tensor: Measurement with shape (K*B, 1, M, N + L - 1), the measurements are grouped by coded aperture
     """
-    y = torch.multiply(x, ca)
+    y = _code(x, ca)
     y = prism_operator(y, shift_sign = 1)
-    return y.sum(dim=1, keepdim=True)
+    return y.sum(dim=1, keepdim=True, dtype=accumulation_dtype(y.dtype)).to(y.dtype)
 
 def backward_color_cassi(y, ca):
     r"""
@@ -58,14 +140,14 @@ def backward_color_cassi(y, ca):
     For more information refer to: Colored Coded Aperture Design by Concentration of Measure in Compressive Spectral Imaging https://doi.org/10.1109/TIP.2014.2310125
 
     Args:
-        y (torch.Tensor): Measurement with shape (B, 1, M, N + L - 1)
-        ca (torch.Tensor): Coded aperture with shape (1, L, M, N)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N + L - 1)
+        ca (torch.Tensor): Coded aperture with shape (1, L, M, N), or a batch of K coded apertures with shape (K, L, M, N)
     Returns:
-        torch.Tensor: Spectral image with shape (B, L, M, N)
+        torch.Tensor: Spectral image with shape (K*B, L, M, N), each measurement is back-projected with its own coded aperture
     """
-    y = torch.tile(y, [1, ca.shape[1], 1, 1])
-    y = prism_operator(y, shift_sign = -1)
-    x = torch.multiply(y, ca)
+    _, L, _, N = ca.shape  # Extract spectral image shape
+    y = _dispersion_view(y, L, N, step=1)  # Shifted windows of the measurement, no copies of y
+    x = _code(y, ca, per_sample=True)
     return x
 
 
@@ -78,16 +160,16 @@ def forward_dd_cassi(x, ca):
 
     Args:
         x (torch.Tensor): Spectral image with shape (B, L, M, N)
-        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N + L - 1)
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N + L - 1), or a batch of K coded apertures with shape (K, 1, M, N + L - 1)
     Returns:
-        torch.Tensor: Measurement with shape (B, 1, M, N)
+        torch.Tensor: Measurement with shape (K*B, 1, M, N), the measurements are grouped by coded aperture
     """
     _, L, M, N = x.shape  # Extract spectral image shape
     assert ca.shape[-1] == N + L - 1, "The coded aperture must have the same size as a dispersed scene"
-    ca = torch.tile(ca, [1, L, 1, 1])
-    ca = prism_operator(ca, shift_sign = -1)
-    y = torch.multiply(x, ca)
-    return y.sum(dim=1, keepdim=True)
+    # A binary coded aperture is cast before it is dispersed, so its L overlapping views are not cast
+    ca = _dispersion_view(_binary_to(ca, x.dtype), L, N, step=1)  # Dispersed coded aperture
+    y = _code(x, ca)
+    return y.sum(dim=1, keepdim=True, dtype=accumulation_dtype(y.dtype)).to(y.dtype)
 
 
 def backward_dd_cassi(y, ca):
@@ -98,17 +180,15 @@ def backward_dd_cassi(y, ca):
     For more information refer to: Single-shot compressive spectral imaging with a dual-disperser architecture https://doi.org/10.1364/OE.15.014013
 
     Args:
-        y (torch.Tensor): Measurement with shape (B, 1, M, N)
-        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N + L - 1)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N)
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N + L - 1), or a batch of K coded apertures with shape (K, 1, M, N + L - 1)
     Returns:
-        torch.Tensor: Spectral image with shape (1, L, M, N)
+        torch.Tensor: Spectral image with shape (K*B, L, M, N), each measurement is back-projected with its own coded aperture
     """
-    _, _, M, N_hat = ca.shape  # Extract spectral image shape
-    L = N_hat - M + 1  # Number of shifts
-    y = torch.tile(y, [1, L, 1, 1])
-    ca = torch.tile(ca, [1, L, 1, 1])
-    ca = prism_operator(ca, shift_sign = -1)
-    return torch.multiply(y, ca)
+    N = y.shape[-1]  # Extract spectral image shape
+    L = ca.shape[-1] - N + 1  # Number of shifts
+    ca = _dispersion_view(_binary_to(ca, y.dtype), L, N, step=1)  # Dispersed coded aperture
+    return _code(y, ca, per_sample=True)
 
 def forward_sd_cassi(x, ca):
     r"""
@@ -118,15 +198,14 @@ def forward_sd_cassi(x, ca):
 
     Args:
         x (torch.Tensor): Spectral image with shape (B, L, M, N)
-        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N)
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N), or a batch of K coded apertures with shape (K, 1, M, N)
     Returns:
-        torch.Tensor: Measurement with shape (B, 1, M, N + L - 1)
+        torch.Tensor: Measurement with shape (K*B, 1, M, N + L - 1), the measurements are grouped by coded aperture
     """
-    y1 = torch.multiply(x, ca)  # Multiplication of the scene by the coded aperture
-    _, M, N, L = y1.shape  # Extract spectral image shape
+    y1 = _code(x, ca)  # Multiplication of the scene by the coded aperture
     # shift and sum
     y2 = prism_operator(y1, shift_sign = 1)
-    return y2.sum(dim=1, keepdim=True)
+    return y2.sum(dim=1, keepdim=True, dtype=accumulation_dtype(y2.dtype)).to(y2.dtype)
 
 
 def backward_sd_cassi(y, ca):
@@ -137,42 +216,223 @@ def backward_sd_cassi(y, ca):
     For more information refer to: Compressive Coded Aperture Spectral Imaging: An Introduction: https://doi.org/10.1109/MSP.2013.2278763
 
     Args:
-        y (torch.Tensor): Measurement with shape (B, 1, M, N + L - 1)
-        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N + L - 1)
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N), or a batch of K coded apertures with shape (K, 1, M, N)
+    Returns:
+        torch.Tensor: Spectral image with shape (K*B, L, M, N), each measurement is back-projected with its own coded aperture
+    """
+    N = ca.shape[-1]  # Extract spectral image shape
+    L = y.shape[-1] - N + 1  # Number of shifts
+    y = _dispersion_view(y, L, N, step=1)  # Shifted windows of the measurement, no copies of y
+    return _code(y, ca, per_sample=True)
+
+
+def multishot_apertures(ca, L, mode="sd"):
+    r"""
+
+    Coded apertures of a multi-shot CASSI system as seen by each spectral band on the detector.
+
+    Args:
+        ca (torch.Tensor): Coded apertures of the K shots with shape (K, 1, M, N) for SD-CASSI, (K, 1, M, N + L - 1) for DD-CASSI or (K, L, M, N) for Color-CASSI
+        L (int): Number of spectral bands
+        mode (str): String, it can be "sd", "dd" or "color"
+    Returns:
+        torch.Tensor: Apertures with shape (K, L, M, N + L - 1) for SD-CASSI and Color-CASSI, where band l is shifted l columns to the right, or (K, L, M, N) for DD-CASSI
+    """
+    if mode == "dd":
+        return _dispersion_view(ca, L, ca.shape[-1] - L + 1, step=1)
+    # A single-channel aperture is repeated over the bands, a dispersed view of a single channel would need a negative band stride
+    return prism_operator(ca.expand(-1, L, -1, -1).contiguous(), shift_sign=1)
+
+
+def forward_multishot_cassi(x, apertures, mode="sd"):
+    r"""
+
+    Forward operator of a multi-shot CASSI system, the K snapshots are computed in a single contraction over the bands.
+
+    The scene is dispersed once and shared by all the shots, instead of being coded and dispersed once per shot.
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N)
+        apertures (torch.Tensor): Apertures from :func:`multishot_apertures` with shape (K, L, M, W)
+        mode (str): String, it can be "sd", "dd" or "color"
+    Returns:
+        torch.Tensor: Measurements with shape (B, K, M, W), one channel per shot
+    """
+    if mode != "dd":
+        x = prism_operator(x, shift_sign = 1)
+    return torch.einsum("blmj,klmj->bkmj", x, apertures)
+
+
+def backward_multishot_cassi(y, apertures, mode="sd"):
+    r"""
+
+    Adjoint of the multi-shot CASSI forward operator, the back-projections of the K snapshots are summed.
+
+    Args:
+        y (torch.Tensor): Measurements with shape (B, K, M, W)
+        apertures (torch.Tensor): Apertures from :func:`multishot_apertures` with shape (K, L, M, W)
+        mode (str): String, it can be "sd", "dd" or "color"
     Returns:
         torch.Tensor: Spectral image with shape (B, L, M, N)
     """
-    _, _, M, N = y.shape  # Extract spectral image shape
-    L = N - M + 1  # Number of shifts
-    y = torch.tile(y, [1, L, 1, 1])
-    y = prism_operator(y, shift_sign = -1)
-    return torch.multiply(y, ca)
+    x = torch.einsum("bkmj,klmj->blmj", y, apertures)
+    if mode != "dd":
+        x = prism_operator(x, shift_sign = -1)
+    return x
+
+
+def optics_grad_color_cassi(x, y, ca):
+    r"""
+
+    Gradient with respect to the coded aperture of the inner product :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` for the Color-CASSI operator
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N + L - 1)
+        ca (torch.Tensor): Coded aperture with shape (K, L, M, N)
+    Returns:
+        torch.Tensor: Gradient with shape (K, L, M, N)
+    """
+    K, L, _, N = ca.shape  # Extract spectral image shape
+    y = _dispersion_view(y, L, N, step=1)
+    return _sum_to_shape(_correlate(x, y, K), ca.shape)
+
+
+def optics_grad_dd_cassi(x, y, ca):
+    r"""
+
+    Gradient with respect to the coded aperture of the inner product :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` for the DD-CASSI operator
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N)
+        ca (torch.Tensor): Coded aperture with shape (K, 1, M, N + L - 1)
+    Returns:
+        torch.Tensor: Gradient with shape (K, 1, M, N + L - 1)
+    """
+    # The coded aperture entry (i, j) meets the scene entries (i, j - l, l)
+    grad = prism_operator(_correlate(x, y, ca.shape[0]), shift_sign = 1)
+    return _sum_to_shape(grad, ca.shape)
+
+
+def optics_grad_sd_cassi(x, y, ca):
+    r"""
+
+    Gradient with respect to the coded aperture of the inner product :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` for the SD-CASSI operator
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N)
+        y (torch.Tensor): Measurement with shape (K*B, 1, M, N + L - 1)
+        ca (torch.Tensor): Coded aperture with shape (K, 1, M, N)
+    Returns:
+        torch.Tensor: Gradient with shape (K, 1, M, N)
+    """
+    L = x.shape[1]  # Number of shifts
+    y = _dispersion_view(y, L, ca.shape[-1], step=1)
+    return _sum_to_shape(_correlate(x, y, ca.shape[0]), ca.shape)
+
+
+def sparse_sd_cassi(ca, L):
+    r"""
+
+    Sparse matrix of the SD-CASSI forward operator, built from the coded aperture.
+
+    The matrix maps the flattened spectral image with shape (L, M, N) to the flattened measurement with shape (1, M, N + L - 1), each column has a single nonzero.
+
+    Args:
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N)
+        L (int): Number of spectral bands
+    Returns:
+        torch.Tensor: Sparse CSR matrix with shape (M*(N + L - 1), L*M*N)
+    """
+    _, _, M, N = ca.shape
+    W = N + L - 1
+    l, m, n = _grid(L, M, N, device=ca.device)
+    values = ca[0, 0].expand(L, M, N)
+    return _csr_matrix(m * W + n + l, (l * M + m) * N + n, values, (M * W, L * M * N))
+
+
+def sparse_dd_cassi(ca, L):
+    r"""
+
+    Sparse matrix of the DD-CASSI forward operator, built from the coded aperture.
+
+    The matrix maps the flattened spectral image with shape (L, M, N) to the flattened measurement with shape (1, M, N), each row has L nonzeros.
+
+    Args:
+        ca (torch.Tensor): Coded aperture with shape (1, 1, M, N + L - 1)
+        L (int): Number of spectral bands
+    Returns:
+        torch.Tensor: Sparse CSR matrix with shape (M*N, L*M*N)
+    """
+    M = ca.shape[-2]
+    N = ca.shape[-1] - L + 1
+    l, m, n = _grid(L, M, N, device=ca.device)
+    values = _dispersion_view(ca, L, N, step=1)[0]
+    return _csr_matrix(m * N + n, (l * M + m) * N + n, values, (M * N, L * M * N))
+
+
+def sparse_color_cassi(ca):
+    r"""
+
+    Sparse matrix of the Color-CASSI forward operator, built from the coded aperture.
+
+    The matrix maps the flattened spectral image with shape (L, M, N) to the flattened measurement with shape (1, M, N + L - 1), each column has a single nonzero.
+
+    Args:
+        ca (torch.Tensor): Coded aperture with shape (1, L, M, N)
+    Returns:
+        torch.Tensor: Sparse CSR matrix with shape (M*(N + L - 1), L*M*N)
+    """
+    _, L, M, N = ca.shape
+    W = N + L - 1
+    l, m, n = _grid(L, M, N, device=ca.device)
+    return _csr_matrix(m * W + n + l, (l * M + m) * N + n, ca[0], (M * W, L * M * N))
 
 
-def forward_spc(x, H):
+def forward_spc(x, H, out: Optional[torch.Tensor] = None):
     r"""
 
     Forward propagation through the Single Pixel Camera (SPC) model.
 
     For more information refer to: Optimized Sensing Matrix for Single Pixel Multi-Resolution Compressive Spectral Imaging 10.1109/TIP.2020.2971150
 
+    The measurement matrix is broadcast over the batch with a zero-stride view instead of being copied, and images in channels last memory format are read without any copy.
+
     Args:
         x (torch.Tensor): Input image tensor of size (B, L, M, N).
-        H (torch.Tensor): Measurement matrix of size (S, M*N).
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+        out (torch.Tensor): Optional output tensor of size (K*B, S, L) where the measurements are written.
 
     Returns:
-        torch.Tensor: Output measurement tensor of size (B, S, L).
+        torch.Tensor: Output measurement tensor of size (K*B, S, L), the measurements are grouped by measurement matrix.
     """
+    dtype = x.dtype
+    # Half precision products are accumulated in float32 by the matrix multiplication kernels, so H is not copied to float32
+    x = x.to(torch.promote_types(dtype, H.dtype))
+    H = H.to(x.dtype)
+
     B, L, M, N = x.size()
-    x = x.contiguous().view(B, L, M*N)
-    x = x.permute(0, 2, 1)
+    if x.is_contiguous(memory_format=torch.channels_last):
+        x = x.permute(0, 2, 3, 1).reshape(B, M*N, L)
+    else:
+        x = x.reshape(B, L, M*N).permute(0, 2, 1)
+
+    if H.dim() == 3:
+        # every sample is measured by each matrix in a single broadcast product
+        y = torch.matmul(H.unsqueeze(1), x).flatten(0, 1)
+    elif out is not None and x.dtype == dtype:
+        # measurement, a single batched product with H shared by all the samples
+        return torch.bmm(H.expand(B, -1, -1), x, out=out)
+    else:
+        y = torch.bmm(H.expand(B, -1, -1), x)
+
+    y = y.to(dtype)
+    return y if out is None else out.copy_(y)
 
-    # measurement
-    H = H.unsqueeze(0).repeat(B, 1, 1)
-    y = torch.bmm(H, x)
-    return y
 
-def backward_spc(y, H):
+def backward_spc(y, H, Hinv: Optional[torch.Tensor] = None, image_size: Optional[Tuple[int, int]] = None):
     r"""
 
     Inverse operation to reconsstruct the image from measurements.
@@ -180,18 +440,695 @@ def backward_spc(y, H):
     For more information refer to: Optimized Sensing Matrix for Single Pixel Multi-Resolution Compressive Spectral Imaging  10.1109/TIP.2020.2971150
 
     Args:
-        y (torch.Tensor): Measurement tensor of size (B, S, L).
+        y (torch.Tensor): Measurement tensor of size (K*B, S, L).
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+        Hinv (torch.Tensor): Precomputed pseudo-inverse of H of size (M*N, S) or (K, M*N, S), it is computed if None.
+        image_size (tuple): Spatial size (M, N) of the image, a square image is assumed if None.
+    Returns:
+        torch.Tensor: Reconstructed image tensor of size (K*B, L, M, N), each measurement is inverted with its own matrix.
+    """
+
+    Hinv = torch.pinverse(H.to(accumulation_dtype(H.dtype))) if Hinv is None else Hinv
+
+    x = _per_matrix(Hinv, y)  # Broadcast over the batch
+    return _spc_image(x, image_size)
+
+
+def cholesky_spc(H):
+    r"""
+
+    Cholesky factor of the Gram matrix of the Single Pixel Camera (SPC) measurement matrix, used by :func:`lstsq_spc`.
+
+    Args:
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+    Returns:
+        torch.Tensor: Lower triangular factor of :math:`\mathbf{H}\mathbf{H}^\top` of size (S, S) if S <= M*N, or of :math:`\mathbf{H}^\top\mathbf{H}` of size (M*N, M*N) otherwise, with a leading dimension K for a batch of matrices.
+    """
+    S, MN = H.shape[-2:]
+    H = H.to(accumulation_dtype(H.dtype))
+    Ht = H.transpose(-2, -1)
+    gram = torch.matmul(H, Ht) if S <= MN else torch.matmul(Ht, H)
+    return torch.linalg.cholesky(gram)
+
+
+def lstsq_spc(y, H, factor=None, image_size=None):
+    r"""
+
+    Least squares reconstruction of the image from Single Pixel Camera (SPC) measurements using a Cholesky factorization.
+
+    For a full rank H it matches :func:`backward_spc`, i.e., the minimum norm solution :math:`\mathbf{H}^\top(\mathbf{H}\mathbf{H}^\top)^{-1}\mathbf{y}` if S <= M*N or :math:`(\mathbf{H}^\top\mathbf{H})^{-1}\mathbf{H}^\top\mathbf{y}` otherwise, without an SVD.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (K*B, S, L).
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+        factor (torch.Tensor): Precomputed factor from :func:`cholesky_spc`, it is computed if None.
+        image_size (tuple): Spatial size (M, N) of the image, a square image is assumed if None.
+    Returns:
+        torch.Tensor: Reconstructed image tensor of size (K*B, L, M, N), each measurement is inverted with its own matrix.
+    """
+    dtype = y.dtype
+    if accumulation_dtype(dtype) != dtype:
+        return lstsq_spc(y.to(accumulation_dtype(dtype)), H.to(accumulation_dtype(dtype)), factor, image_size).to(dtype)
+
+    S, MN = H.shape[-2:]
+    K = H.shape[0] if H.dim() == 3 else 1
+    KB, _, L = y.shape
+    B = KB // K
+
+    if factor is None:
+        factor = cholesky_spc(H)
+
+    Ht = H.transpose(-2, -1)
+    y = y.reshape(K, B, S, L).permute(0, 2, 1, 3).reshape(*H.shape[:-2], S, B * L)  # Batch and bands as right-hand sides
+    if S <= MN:
+        x = torch.matmul(Ht, torch.cholesky_solve(y, factor))
+    else:
+        x = torch.cholesky_solve(torch.matmul(Ht, y), factor)
+
+    x = x.reshape(K, MN, B, L).permute(0, 2, 1, 3).reshape(KB, MN, L)
+    return _spc_image(x, image_size)
+
+
+def adjoint_spc(y, H, image_size: Optional[Tuple[int, int]] = None):
+    r"""
+
+    Adjoint (transpose) of the Single Pixel Camera (SPC) forward model.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (K*B, S, L).
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+        image_size (tuple): Spatial size (M, N) of the image, a square image is assumed if None.
+    Returns:
+        torch.Tensor: Image tensor of size (K*B, L, M, N), each measurement is back-projected with its own matrix.
+    """
+    x = _per_matrix(H.transpose(-2, -1), y)
+    return _spc_image(x, image_size)
+
+
+def optics_grad_spc(x, y, H):
+    r"""
+
+    Gradient with respect to the measurement matrix of the inner product :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` for the SPC operator
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        y (torch.Tensor): Measurement tensor of size (K*B, S, L).
+        H (torch.Tensor): Measurement matrix of size (S, M*N) or (K, S, M*N).
+    Returns:
+        torch.Tensor: Gradient with the size of H.
+    """
+    B, L, M, N = x.size()
+    S = H.shape[-2]
+    x = x.reshape(B * L, M * N)
+    y = y.reshape(-1, B, S, L).permute(0, 2, 1, 3).reshape(-1, S, B * L)
+    return torch.matmul(y, x).reshape(H.shape)
+
+
+def gram_spc(x, H, G=None):
+    r"""
+
+    Gram operator :math:`\mathbf{H}^\top\mathbf{H}` of the Single Pixel Camera (SPC) model applied with the Gram matrix.
+
+    It costs :math:`(MN)^2` operations per band instead of :math:`2SMN` for the forward and adjoint operators, so it is cheaper when :math:`MN < 2S`.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        H (torch.Tensor): Measurement matrix of size (S, M*N), or a batch of K measurement matrices of size (K, S, M*N).
+        G (torch.Tensor): Precomputed Gram matrix of size (M*N, M*N) or (K, M*N, M*N), it is computed if None.
+    Returns:
+        torch.Tensor: Image tensor of size (K*B, L, M, N).
+    """
+    dtype = x.dtype
+    if G is None:
+        G = torch.matmul(H.transpose(-2, -1), H)
+    # Half precision products are accumulated in float32 by the matrix multiplication kernels, so G is not copied to float32
+    x = x.to(torch.promote_types(dtype, G.dtype))
+    G = G.to(x.dtype)
+    B, L, M, N = x.size()
+    x = x.reshape(B, L, M*N)
+    if G.dim() == 3:
+        return torch.matmul(x.unsqueeze(0), G.unsqueeze(1)).reshape(-1, L, M, N).to(dtype)
+    return torch.matmul(x, G).reshape(B, L, M, N).to(dtype)  # G is symmetric
+
+
+def sparse_spc(H, L):
+    r"""
+
+    Sparse matrix of the Single Pixel Camera (SPC) forward operator, built from the measurement matrix.
+
+    The matrix maps the flattened image with shape (L, M, N) to the flattened measurements with shape (S, L), the bands are not mixed so only one in L entries of each row is nonzero.
+
+    Args:
         H (torch.Tensor): Measurement matrix of size (S, M*N).
+        L (int): Number of spectral bands.
+    Returns:
+        torch.Tensor: Sparse CSR matrix with shape (S*L, L*M*N)
+    """
+    S, MN = H.shape
+    s, l, p = _grid(S, L, MN, device=H.device)
+    values = H.unsqueeze(1).expand(S, L, MN)
+    return _csr_matrix(s * L + l, l * MN + p, values, (S * L, L * MN))
+
+
+def forward_separable_spc(x, H):
+    r"""
+
+    Forward propagation through the Single Pixel Camera (SPC) model with a separable measurement matrix :math:`\mathbf{H} = \mathbf{H}_r \otimes \mathbf{H}_c`.
+
+    The measurements :math:`\mathbf{Y} = \mathbf{H}_r \mathbf{X} \mathbf{H}_c^\top` of each band are computed with two matrix products, without building :math:`\mathbf{H}`.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        H (tuple): Measurement matrices (H_r, H_c) of the rows and columns, of size (S_r, M) and (S_c, N).
+    Returns:
+        torch.Tensor: Output measurement tensor of size (B, L, S_r, S_c).
+    """
+    H_rows, H_cols = H
+    return torch.matmul(torch.matmul(H_rows, x), H_cols.t())
+
+
+def backward_separable_spc(y, H, Hinv=None):
+    r"""
+
+    Inverse operation to reconstruct the image from separable Single Pixel Camera (SPC) measurements.
+
+    The pseudo-inverse of :math:`\mathbf{H}_r \otimes \mathbf{H}_c` is :math:`\mathbf{H}_r^\dagger \otimes \mathbf{H}_c^\dagger`, so only the pseudo-inverses of the factors are needed.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (B, L, S_r, S_c).
+        H (tuple): Measurement matrices (H_r, H_c) of the rows and columns, of size (S_r, M) and (S_c, N).
+        Hinv (tuple): Precomputed pseudo-inverses of H_r and H_c, they are computed if None.
     Returns:
         torch.Tensor: Reconstructed image tensor of size (B, L, M, N).
     """
+    if Hinv is None:
+        Hinv = [torch.pinverse(h) for h in H]
+    H_rows_inv, H_cols_inv = Hinv
+    return torch.matmul(torch.matmul(H_rows_inv, y), H_cols_inv.t())
+
+
+def adjoint_separable_spc(y, H):
+    r"""
+
+    Adjoint (transpose) of the separable Single Pixel Camera (SPC) forward model, :math:`\mathbf{X} = \mathbf{H}_r^\top \mathbf{Y} \mathbf{H}_c`.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (B, L, S_r, S_c).
+        H (tuple): Measurement matrices (H_r, H_c) of the rows and columns, of size (S_r, M) and (S_c, N).
+    Returns:
+        torch.Tensor: Image tensor of size (B, L, M, N).
+    """
+    H_rows, H_cols = H
+    return torch.matmul(torch.matmul(H_rows.t(), y), H_cols)
+
+
+def gram_separable_spc(x, H, G=None):
+    r"""
+
+    Gram operator of the separable Single Pixel Camera (SPC) model, :math:`\mathbf{X} \mapsto (\mathbf{H}_r^\top\mathbf{H}_r) \mathbf{X} (\mathbf{H}_c^\top\mathbf{H}_c)`.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        H (tuple): Measurement matrices (H_r, H_c) of the rows and columns, of size (S_r, M) and (S_c, N).
+        G (tuple): Precomputed Gram matrices of H_r and H_c, of size (M, M) and (N, N), they are computed if None.
+    Returns:
+        torch.Tensor: Image tensor of size (B, L, M, N).
+    """
+    if G is None:
+        G = [torch.matmul(h.t(), h) for h in H]
+    G_rows, G_cols = G
+    return torch.matmul(torch.matmul(G_rows, x), G_cols)
+
+
+def forward_block_spc(x, H):
+    r"""
+
+    Forward propagation through the block-based Single Pixel Camera (SPC) model.
+
+    The image is split into non-overlapping :math:`b \times b` blocks that are measured with the same matrix, so all the blocks are measured with a single batched product.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N), M and N must be multiples of the block size b.
+        H (torch.Tensor): Measurement matrix of the blocks of size (S, b*b).
+    Returns:
+        torch.Tensor: Output measurement tensor of size (B, L, S, K), with K = (M/b)(N/b) the number of blocks.
+    """
+    B, L, M, N = x.size()
+    block_size = int(round(H.shape[-1] ** 0.5))
+    blocks = torch.nn.functional.unfold(x, block_size, stride=block_size)  # (B, L*b*b, K)
+    blocks = blocks.reshape(B, L, block_size ** 2, -1)
+    return torch.matmul(H, blocks)
+
+
+def backward_block_spc(y, H, image_size, Hinv=None):
+    r"""
+
+    Inverse operation to reconstruct the image from block-based Single Pixel Camera (SPC) measurements.
+
+    Each block is reconstructed with the pseudo-inverse of the block measurement matrix and the blocks are placed back in the image.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (B, L, S, K).
+        H (torch.Tensor): Measurement matrix of the blocks of size (S, b*b).
+        image_size (tuple): Spatial size (M, N) of the image.
+        Hinv (torch.Tensor): Precomputed pseudo-inverse of H of size (b*b, S), it is computed if None.
+    Returns:
+        torch.Tensor: Reconstructed image tensor of size (B, L, M, N).
+    """
+    if Hinv is None:
+        Hinv = torch.pinverse(H)
+    return _fold_blocks(torch.matmul(Hinv, y), image_size)
+
+
+def adjoint_block_spc(y, H, image_size):
+    r"""
+
+    Adjoint (transpose) of the block-based Single Pixel Camera (SPC) forward model.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (B, L, S, K).
+        H (torch.Tensor): Measurement matrix of the blocks of size (S, b*b).
+        image_size (tuple): Spatial size (M, N) of the image.
+    Returns:
+        torch.Tensor: Image tensor of size (B, L, M, N).
+    """
+    return _fold_blocks(torch.matmul(H.t(), y), image_size)
+
+
+def gram_block_spc(x, H, G=None):
+    r"""
+
+    Gram operator of the block-based Single Pixel Camera (SPC) model applied with the Gram matrix of the blocks.
+
+    It costs :math:`b^4` operations per block instead of :math:`2Sb^2` for the forward and adjoint operators, so it is cheaper when :math:`b^2 < 2S`.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        H (torch.Tensor): Measurement matrix of the blocks of size (S, b*b).
+        G (torch.Tensor): Precomputed Gram matrix of size (b*b, b*b), it is computed if None.
+    Returns:
+        torch.Tensor: Image tensor of size (B, L, M, N).
+    """
+    if G is None:
+        G = torch.matmul(H.t(), H)
+    return _fold_blocks(forward_block_spc(x, G), x.shape[-2:])
+
+
+def optics_grad_block_spc(x, y, H):
+    r"""
+
+    Gradient with respect to the block measurement matrix of the inner product :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` for the block-based SPC operator
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N).
+        y (torch.Tensor): Measurement tensor of size (B, L, S, K).
+        H (torch.Tensor): Measurement matrix of the blocks of size (S, b*b).
+    Returns:
+        torch.Tensor: Gradient of size (S, b*b).
+    """
+    S, block_pixels = H.shape
+    block_size = int(round(block_pixels ** 0.5))
+    blocks = torch.nn.functional.unfold(x, block_size, stride=block_size)  # (B, L*b*b, K)
+    blocks = blocks.reshape(x.shape[0], x.shape[1], block_pixels, -1)
+    y = y.permute(2, 0, 1, 3).reshape(S, -1)
+    blocks = blocks.permute(0, 1, 3, 2).reshape(-1, block_pixels)
+    return torch.matmul(y, blocks)
+
+
+def _fold_blocks(blocks, image_size):
+    r"""
+    Places blocks with shape (B, L, b*b, K) back into an image with shape (B, L, M, N).
+    """
+    B, L, block_pixels, K = blocks.size()
+    block_size = int(round(block_pixels ** 0.5))
+    blocks = blocks.reshape(B, L * block_pixels, K)
+    return torch.nn.functional.fold(blocks, image_size, block_size, stride=block_size)
+
+
+def fwht(x):
+    r"""
+
+    Fast Walsh-Hadamard transform along the last dimension, with orthonormal scaling and natural (Hadamard) ordering.
+
+    The transform is computed with :math:`\log_2 n` butterfly stages, i.e., in :math:`O(n \log n)` operations, without building the Hadamard matrix. 
+    As the orthonormal Hadamard matrix is symmetric and orthogonal, the transform is its own inverse.
+
+    Args:
+        x (torch.Tensor): Input tensor with shape (..., n), n must be a power of two.
+    Returns:
+        torch.Tensor: Transformed tensor with shape (..., n).
+    """
+    *batch, n = x.shape
+    assert n > 0 and n & (n - 1) == 0, "The length of the transform must be a power of two"
+
+    h = 1
+    while h < n:
+        # Butterflies between the entries i and i + h of each block of size 2h
+        x = x.reshape(*batch, n // (2 * h), 2, h)
+        a, b = x.select(-2, 0), x.select(-2, 1)
+        x = torch.stack((a + b, a - b), dim=-2)
+        h *= 2
+
+    return x.reshape(*batch, n) / n ** 0.5
+
+
+def hadamard_ordering(n, ordering="sequency"):
+    r"""
+
+    Ordering of the rows of the :math:`n \times n` Hadamard matrix.
+
+    Args:
+        n (int): Size of the Hadamard matrix, it must be a power of two.
+        ordering (str): String, it can be "natural" for the Sylvester construction, "sequency" for the Walsh ordering by number of sign changes, or "random" for a random permutation.
+    Returns:
+        torch.Tensor: Indices of the rows of the natural Hadamard matrix with shape (n,).
+    """
+    assert n > 0 and n & (n - 1) == 0, "The size of the Hadamard matrix must be a power of two"
+    rows = torch.arange(n)
+
+    if ordering == "natural":
+        return rows
+    elif ordering == "sequency":
+        # The k-th Walsh function is the natural row given by the bit reversal of the Gray code of k
+        gray = rows ^ (rows >> 1)
+        bits = n.bit_length() - 1
+        rows = torch.zeros_like(gray)
+        for b in range(bits):
+            rows |= ((gray >> b) & 1) << (bits - 1 - b)
+        return rows
+    elif ordering == "random":
+        return torch.randperm(n)
+    else:
+        raise ValueError("ordering must be natural, sequency or random")
+
+
+def forward_hadamard_spc(x, rows):
+    r"""
+
+    Forward propagation through the Single Pixel Camera (SPC) model with Hadamard patterns.
+
+    The patterns are the selected rows of the orthonormal Hadamard matrix of size M*N, which is never stored, the measurements are computed with :func:`fwht`.
+
+    Args:
+        x (torch.Tensor): Input image tensor of size (B, L, M, N), M*N must be a power of two.
+        rows (torch.Tensor): Indices of the rows of the natural Hadamard matrix used as patterns, with size (S,).
+    Returns:
+        torch.Tensor: Output measurement tensor of size (B, S, L).
+    """
+    B, L, M, N = x.size()
+    x = fwht(x.reshape(B, L, M*N))
+    return torch.index_select(x, -1, rows).permute(0, 2, 1)
+
+
+def backward_hadamard_spc(y, rows, image_size):
+    r"""
+
+    Adjoint of the Single Pixel Camera (SPC) model with Hadamard patterns.
+
+    As the patterns are orthonormal, the adjoint is also the pseudo-inverse of the forward model.
+
+    Args:
+        y (torch.Tensor): Measurement tensor of size (B, S, L).
+        rows (torch.Tensor): Indices of the rows of the natural Hadamard matrix used as patterns, with size (S,).
+        image_size (tuple): Spatial size (M, N) of the image.
+    Returns:
+        torch.Tensor: Image tensor of size (B, L, M, N).
+    """
+    B, S, L = y.size()
+    M, N = image_size
+    x = y.new_zeros(B, L, M*N).index_copy(-1, rows, y.permute(0, 2, 1))
+    return fwht(x).reshape(B, L, M, N)
+
+
+def _per_matrix(A, x):
+    r"""
+    Multiplies each sample of x with shape (K*B, P, L) by its matrix in the batch A with shape (K, Q, P), or by A if it is a single matrix.
+    """
+    dtype = x.dtype
+    # A half precision matrix is multiplied in its own dtype, the kernels accumulate in float32, and a float32 matrix, e.g. a pseudo-inverse, is not rounded
+    x = x.to(torch.promote_types(dtype, A.dtype))
+    A = A.to(x.dtype)
+    if A.dim() == 2:
+        y = torch.matmul(A, x)  # Broadcast over the batch
+    else:
+        y = torch.matmul(A.unsqueeze(1), x.unflatten(0, [A.shape[0], -1])).flatten(0, 1)
+    return y.to(dtype)
+
+
+def transfer_function_doe(wavelengths, shape, pixel_size, distance):
+    r"""
+
+    Transfer functions of the angular spectrum propagation of a field over a distance, for each wavelength.
+
+    .. math::
+        H_{\lambda}(f_x, f_y) = \exp\left(i 2\pi z \sqrt{\lambda^{-2} - f_x^2 - f_y^2}\right)
+
+    The evanescent frequencies, :math:`f_x^2 + f_y^2 > \lambda^{-2}`, are removed.
+
+    Args:
+        wavelengths (torch.Tensor): Wavelengths with shape (L,), in meters.
+        shape (tuple): Size (M, N) of the sampled field.
+        pixel_size (float): Sampling period of the field, in meters.
+        distance (float): Propagation distance, in meters.
+    Returns:
+        torch.Tensor: Complex transfer functions with shape (L, M, N), in the frequency order of :func:`torch.fft.fft2`.
+    """
+    M, N = shape
+    fy = torch.fft.fftfreq(M, d=pixel_size, dtype=wavelengths.dtype, device=wavelengths.device)
+    fx = torch.fft.fftfreq(N, d=pixel_size, dtype=wavelengths.dtype, device=wavelengths.device)
+    fy, fx = torch.meshgrid(fy, fx, indexing="ij")
+    squared = wavelengths.reshape(-1, 1, 1) ** -2 - fx ** 2 - fy ** 2
+    propagating = (squared > 0).to(wavelengths.dtype)
+    return torch.polar(propagating, 2 * np.pi * distance * squared.clamp(min=0).sqrt())
+
+
+def psf_doe(height_map, wavelengths, transfer_function, aperture=None, refractive_index=1.5):
+    r"""
+
+    Point spread functions of a diffractive optical element (DOE) for each wavelength.
 
-    Hinv = torch.pinverse(H)
-    Hinv = Hinv.unsqueeze(0).repeat(y.shape[0], 1, 1)
+    The height map delays the phase of a plane wave by :math:`\phi_{\lambda} = \frac{2\pi}{\lambda}(n - 1)h`, the field is propagated to the sensor with the angular spectrum method and the PSF is its normalized intensity. 
+    All the wavelengths are propagated with a single batched FFT.
 
-    x = torch.bmm(Hinv, y)
+    Args:
+        height_map (torch.Tensor): Height map of the DOE with shape (Mh, Nh), in meters.
+        wavelengths (torch.Tensor): Wavelengths with shape (L,), in meters.
+        transfer_function (torch.Tensor): Transfer functions from :func:`transfer_function_doe` with shape (L, Mh, Nh).
+        aperture (torch.Tensor): Amplitude of the aperture with shape (Mh, Nh), if None the whole DOE is illuminated.
+        refractive_index (float): Refractive index of the DOE material.
+    Returns:
+        torch.Tensor: PSFs with shape (1, L, Mh, Nh), each one sums to one and is centered at (Mh // 2, Nh // 2).
+    """
+    phase = 2 * np.pi * (refractive_index - 1) * height_map / wavelengths.reshape(-1, 1, 1)
+    amplitude = torch.ones_like(phase) if aperture is None else aperture.expand_as(phase)
+    field = torch.fft.ifft2(torch.fft.fft2(torch.polar(amplitude, phase)) * transfer_function)
+    psf = field.real ** 2 + field.imag ** 2
+    psf = psf / psf.sum(dim=(-2, -1), keepdim=True)
+    return psf.unsqueeze(0)
+
+
+def psf_spectrum_doe(psf, image_size):
+    r"""
+
+    Spectrum of the zero-padded PSFs used by :func:`forward_doe` and :func:`backward_doe`, so that the circular convolution of the FFT is a linear convolution.
+
+    Args:
+        psf (torch.Tensor): PSFs with shape (1, L, Mh, Nh).
+        image_size (tuple): Size (M, N) of the image.
+    Returns:
+        torch.Tensor: Half spectrum from :func:`torch.fft.rfft2` with shape (1, L, M + Mh - 1, (N + Nh - 1) // 2 + 1).
+    """
+    M, N = image_size
+    Mh, Nh = psf.shape[-2:]
+    return torch.fft.rfft2(psf, s=(M + Mh - 1, N + Nh - 1))
+
+
+def forward_doe(x, spectrum, psf_size):
+    r"""
+
+    Forward operator of a PSF-based system, each band of the image is convolved with its PSF.
+
+    The convolution is linear and the output keeps the size of the image, with the PSF centered at (Mh // 2, Nh // 2). It is computed with real FFTs of all the bands at once.
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N).
+        spectrum (torch.Tensor): Spectrum of the PSFs from :func:`psf_spectrum_doe`.
+        psf_size (tuple): Size (Mh, Nh) of the PSFs.
+    Returns:
+        torch.Tensor: Measurement with shape (B, L, M, N).
+    """
+    M, N = x.shape[-2:]
+    Mh, Nh = psf_size
+    s = (M + Mh - 1, N + Nh - 1)
+    y = torch.fft.irfft2(torch.fft.rfft2(x, s=s) * spectrum, s=s)
+    return y[..., Mh // 2:Mh // 2 + M, Nh // 2:Nh // 2 + N]
+
+
+def backward_doe(y, spectrum, psf_size):
+    r"""
+
+    Adjoint of :func:`forward_doe`, each band of the measurement is correlated with its PSF.
+
+    Args:
+        y (torch.Tensor): Measurement with shape (B, L, M, N).
+        spectrum (torch.Tensor): Spectrum of the PSFs from :func:`psf_spectrum_doe`.
+        psf_size (tuple): Size (Mh, Nh) of the PSFs.
+    Returns:
+        torch.Tensor: Spectral image with shape (B, L, M, N).
+    """
+    M, N = y.shape[-2:]
+    Mh, Nh = psf_size
+    s = (M + Mh - 1, N + Nh - 1)
+    # The measurement is placed where the cropped convolution was read, the correlation is the product with the conjugate spectrum
+    y = torch.nn.functional.pad(y, (Nh // 2, Nh - 1 - Nh // 2, Mh // 2, Mh - 1 - Mh // 2))
+    x = torch.fft.irfft2(torch.fft.rfft2(y) * spectrum.conj(), s=s)
+    return x[..., :M, :N]
+
+
+def tiled_convolution(x, spectrum, psf_size, tile_size):
+    r"""
+
+    Overlap-add FFT convolution of each band of the image with its PSF, computed in tiles.
+
+    It matches :func:`forward_doe`, but the image is split into tiles of size (T_m, T_n) that are convolved with FFTs of size (T_m + Mh - 1, T_n + Nh - 1) and added at their overlaps. 
+    A row of tiles is processed at a time, so the memory of the FFTs is bounded by the tile size instead of the image size.
+
+    Args:
+        x (torch.Tensor): Spectral image with shape (B, L, M, N).
+        spectrum (torch.Tensor): Spectrum of the PSFs from :func:`psf_spectrum_doe` computed with image_size=tile_size.
+        psf_size (tuple): Size (Mh, Nh) of the PSFs.
+        tile_size (tuple): Size (T_m, T_n) of the tiles.
+    Returns:
+        torch.Tensor: Measurement with shape (B, L, M, N).
+    """
+    B, L, M, N = x.shape
+    (Mh, Nh), (Tm, Tn) = psf_size, tile_size
+    P, Q = Tm + Mh - 1, Tn + Nh - 1
+    n_rows, n_cols = -(-M // Tm), -(-N // Tn)
+    x = torch.nn.functional.pad(x, (0, n_cols * Tn - N, 0, n_rows * Tm - M))
+
+    out = x.new_zeros(B, L, n_rows * Tm + Mh - 1, n_cols * Tn + Nh - 1)
+    for i in range(n_rows):
+        tiles = x[..., i * Tm:(i + 1) * Tm, :].unflatten(-1, (n_cols, Tn)).transpose(-3, -2)  # (B, L, n_cols, Tm, Tn)
+        tiles = torch.fft.irfft2(torch.fft.rfft2(tiles, s=(P, Q)) * spectrum.unsqueeze(2), s=(P, Q))
+        # Overlap-add of the tiles of the row along the columns
+        tiles = tiles.permute(0, 1, 3, 4, 2).reshape(B, L * P * Q, n_cols)
+        out[..., i * Tm:i * Tm + P, :] += torch.nn.functional.fold(tiles, output_size=(P, out.shape[-1]), kernel_size=(P, Q), stride=(1, Tn))
+
+    return out[..., Mh // 2:Mh // 2 + M, Nh // 2:Nh // 2 + N]
+
+
+def tiled_correlation(y, spectrum, psf_size, tile_size):
+    r"""
+
+    Overlap-save FFT correlation of each band of the measurement with its PSF, computed in tiles, the adjoint of :func:`tiled_convolution`.
+
+    Each output tile of size (T_m, T_n) is read from a window of size (T_m + Mh - 1, T_n + Nh - 1) of the measurement, the samples of the circular correlation that wrap around are discarded.
+
+    Args:
+        y (torch.Tensor): Measurement with shape (B, L, M, N).
+        spectrum (torch.Tensor): Spectrum of the PSFs from :func:`psf_spectrum_doe` computed with image_size=tile_size.
+        psf_size (tuple): Size (Mh, Nh) of the PSFs.
+        tile_size (tuple): Size (T_m, T_n) of the tiles.
+    Returns:
+        torch.Tensor: Spectral image with shape (B, L, M, N).
+    """
+    B, L, M, N = y.shape
+    (Mh, Nh), (Tm, Tn) = psf_size, tile_size
+    P, Q = Tm + Mh - 1, Tn + Nh - 1
+    n_rows, n_cols = -(-M // Tm), -(-N // Tn)
+    # The measurement is placed where the cropped convolution was read
+    y = torch.nn.functional.pad(y, (Nh // 2, n_cols * Tn - N + Nh - 1 - Nh // 2, Mh // 2, n_rows * Tm - M + Mh - 1 - Mh // 2))
+
+    rows = []
+    for i in range(n_rows):
+        windows = y[..., i * Tm:i * Tm + P, :].unfold(-1, Q, Tn).transpose(-3, -2)  # (B, L, n_cols, P, Q)
+        tiles = torch.fft.irfft2(torch.fft.rfft2(windows) * spectrum.conj().unsqueeze(2), s=(P, Q))[..., :Tm, :Tn]
+        rows.append(tiles.transpose(-3, -2).flatten(-2))
+
+    return torch.cat(rows, dim=-2)[..., :M, :N]
+
+
+def _spc_image(x, image_size: Optional[Tuple[int, int]] = None):
+    r"""
+    Reshapes pixels with shape (B, M*N, L) into an image with shape (B, L, M, N), a square image is assumed if image_size is None.
+    """
     x = x.permute(0, 2, 1)
     b, c, hw = x.size()
-    h = int(np.sqrt(hw))
-    x = x.reshape(b, c, h, h)
-    return x
\ No newline at end of file
+    if image_size is None:
+        M = int(hw ** 0.5)
+        N = M
+    else:
+        M, N = image_size
+    return x.reshape(b, c, M, N)
+
+
+def _grid(*sizes, device=None):
+    r"""
+    Index grids of a tensor with the given sizes.
+    """
+    return torch.meshgrid(*[torch.arange(size, device=device) for size in sizes], indexing="ij")
+
+
+def _csr_matrix(rows, cols, values, shape):
+    r"""
+    Sparse CSR matrix from the coordinates and values of its nonzeros.
+    """
+    indices = torch.stack([rows.flatten(), cols.flatten()])
+    return torch.sparse_coo_tensor(indices, values.flatten(), shape).coalesce().to_sparse_csr()
+
+
+def _sum_to_shape(x, shape):
+    r"""
+    Sums x over the dimensions that are broadcast in shape.
+    """
+    dims = [d for d in range(x.dim()) if shape[d] == 1 and x.shape[d] != 1]
+    return x.sum(dim=dims, keepdim=True) if dims else x
+
+
+class LinearOperatorFunction(torch.autograd.Function):
+    r"""
+
+    Autograd function of a linear sensing operator :math:`\forwardLinear_{\learnedOptics}` whose backward pass is given analytically.
+
+    The gradient with respect to the input is the adjoint operator applied to the incoming gradient, and the gradient with respect to the optics is given by ``optics_grad``.
+    Only the inputs are saved for the backward pass, so none of the intermediate tensors of the operator are kept alive.
+
+    Usage: ``LinearOperatorFunction.apply(x, optics, operator, adjoint, optics_grad, transpose)``
+
+    Args:
+        x (torch.Tensor): Input tensor of the operator
+        optics (torch.Tensor): Optical element, e.g., the coded aperture
+        operator (function): Linear operator, ``operator(x, optics)``
+        adjoint (function): Adjoint of the operator, ``adjoint(y, optics)``
+        optics_grad (function): Gradient of :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` with respect to the optics, ``optics_grad(x, y, optics)``
+        transpose (bool): If True, operator is the adjoint of the sensing model described by ``optics_grad``
+    """
+
+    @staticmethod
+    def forward(ctx, x, optics, operator, adjoint, optics_grad, transpose=False):
+        ctx.save_for_backward(x, optics)
+        ctx.adjoint = adjoint
+        ctx.optics_grad = optics_grad
+        ctx.transpose = transpose
+        return operator(x, optics)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, optics = ctx.saved_tensors
+        grad_x = grad_optics = None
+
+        if ctx.needs_input_grad[0]:
+            grad_x = ctx.adjoint(grad_output, optics)
+            if grad_x.shape[0] != x.shape[0]:
+                # The samples were measured by a batch of optics, the adjoint sums their back-projections
+                grad_x = grad_x.unflatten(0, (-1, x.shape[0])).sum(dim=0)
+            grad_x = grad_x.reshape(x.shape)
+
+        if ctx.needs_input_grad[1]:
+            if ctx.transpose:
+                grad_optics = ctx.optics_grad(grad_output, x, optics)
+            else:
+                grad_optics = ctx.optics_grad(x, grad_output, optics)
+
+        return grad_x, grad_optics, None, None, None, None
\ No newline at end of file
@@ -1,5 +1,9 @@
 import torch
-from .functional import forward_spc, backward_spc
+from functools import partial
+from .functional import forward_spc, backward_spc, adjoint_spc, optics_grad_spc, cholesky_spc, lstsq_spc, gram_spc, sparse_spc, accumulation_dtype
+from .functional import forward_hadamard_spc, backward_hadamard_spc, hadamard_ordering
+from .functional import forward_separable_spc, backward_separable_spc, adjoint_separable_spc, gram_separable_spc
+from .functional import forward_block_spc, backward_block_spc, adjoint_block_spc, optics_grad_block_spc, gram_block_spc
 from .utils import BaseOpticsLayer
 
 class SPC(BaseOpticsLayer):
@@ -27,27 +31,48 @@ class SPC(BaseOpticsLayer):
 
     
     """
-    def __init__(self, input_shape, n_measurements=256, trainable=False, initial_ca=None, **kwargs):
+
+    optics_ndim = 2
+
+    def __init__(self, input_shape, n_measurements=256, trainable=False, initial_ca=None, backward_method="pinv", n_apertures=1, **kwargs):
         r"""       
 
         Args:
             input_shape (tuple): Tuple, shape of the input image (L, M, N).
             n_measurements (int): Number of measurements.
             trainable (bool): Boolean, if True the coded aperture is trainable
-            initial_ca (torch.Tensor): Initial coded aperture with shape (S, M*N)
+            initial_ca (torch.Tensor): Initial coded aperture with shape (S, M*N), or a batch of K coded apertures with shape (K, S, M*N)
+            backward_method (str): String, backward operator, it can be "pinv" for the pseudo-inverse, "lstsq" for the least squares solution with a Cholesky factorization or "transpose" for the adjoint. 
+                The pseudo-inverse and the Cholesky factor are cached until the coded aperture changes.
+            n_apertures (int): Number K of random coded apertures if initial_ca is None. Each one measures every sample, so a batch of B samples produces K*B measurements grouped by coded aperture.
         """
         #super(SPC, self).__init__()
         _, M, N = input_shape
+        self.input_shape = tuple(input_shape)
+        self.M, self.N = M, N
         self.trainable = trainable
         self.initial_ca = initial_ca
         if self.initial_ca is None:
-            initializer = torch.randn((n_measurements, M*N), requires_grad=self.trainable)
+            shape = (n_measurements, M*N) if n_apertures == 1 else (n_apertures, n_measurements, M*N)
+            initializer = torch.randn(shape, requires_grad=self.trainable)
         else:
             initializer = torch.from_numpy(self.initial_ca).float()
 
         #Add parameter CA in pytorch manner
         ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
-        super(SPC, self).__init__(learnable_optics=ca, sensing=forward_spc, backward=backward_spc)
+        self.measurement_shape = (ca.shape[-2], input_shape[0])
+
+        adjoint = partial(adjoint_spc, image_size=(M, N))
+        if backward_method == "pinv":
+            backward = self._pinv_backward
+        elif backward_method == "lstsq":
+            backward = self._lstsq_backward
+        elif backward_method == "transpose":
+            backward = adjoint
+        else:
+            raise ValueError("backward_method must be pinv, lstsq or transpose")
+
+        super(SPC, self).__init__(learnable_optics=ca, sensing=forward_spc, backward=backward, adjoint=adjoint, optics_grad=optics_grad_spc)
 
 
     def forward(self, x, type_calculation="forward"):
@@ -61,4 +86,236 @@ class SPC(BaseOpticsLayer):
             torch.Tensor: Output tensor after measurement of size (B, S, L).
         """
         return super(SPC, self).forward(x, type_calculation)
-        
\ No newline at end of file
+
+    def gram(self, x):
+        r"""
+        Applies the Gram operator :math:`\learnedOptics^\top\learnedOptics`, with the cached Gram matrix when it is cheaper than the forward and adjoint operators.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+
+        Returns:
+            torch.Tensor: Output tensor of size (B, L, M, N).
+        """
+        H = self.learnable_optics
+        trained = H.requires_grad and torch.is_grad_enabled()
+        if trained or self.M * self.N >= 2 * H.shape[-2]:
+            return super(SPC, self).gram(x)
+        return gram_spc(x, H, G=self.cached("gram", lambda H: torch.matmul(H.transpose(-2, -1), H)))
+
+    def _pinv_backward(self, y, H):
+        Hinv = self.cached("pinv", lambda H: torch.linalg.pinv(H.to(accumulation_dtype(H.dtype))), H)
+        return backward_spc(y, H, Hinv=Hinv, image_size=(self.M, self.N))
+
+    def _sparse_matrix(self, H):
+        return sparse_spc(H, self.input_shape[0])
+
+    def _lstsq_backward(self, y, H):
+        factor = self.cached("cholesky", cholesky_spc, H)
+        return lstsq_spc(y, H, factor=factor, image_size=(self.M, self.N))
+
+
+class HadamardSPC(BaseOpticsLayer):
+
+    r"""
+    Single Pixel Camera (SPC) with Hadamard patterns.
+
+    The SPC model is 
+
+    .. math::
+        \begin{align*}
+        \forwardLinear_{\learnedOptics}: \mathbf{x} &\mapsto \mathbf{y} \\
+                        \mathbf{y}_{s, l} &=  \sum_{i=1}^{M}\sum_{j = 1}^{N} \learnedOptics_{s, i, j} \mathbf{x}_{l, i, j}
+        \end{align*}
+
+    where the patterns :math:`\learnedOptics_{s}` are :math:`S` rows of the orthonormal Hadamard matrix of size :math:`MN`, taken in natural, sequency (Walsh) or random order. 
+    
+    The forward and backward operators are computed with a fast Walsh-Hadamard transform in :math:`O(MN \log MN)` operations, and the sensing matrix is never stored, so only the indices of the selected rows are kept.
+    Since the patterns are orthonormal, the backward operator is both the adjoint and the pseudo-inverse of the forward operator.
+    """
+
+    def __init__(self, input_shape, n_measurements=256, ordering="sequency", **kwargs):
+        r"""
+
+        Args:
+            input_shape (tuple): Tuple, shape of the input image (L, M, N), M*N must be a power of two.
+            n_measurements (int): Number of measurements.
+            ordering (str): String, order of the Hadamard rows, it can be "natural", "sequency" or "random". The first n_measurements rows are used.
+        """
+        _, M, N = input_shape
+        self.input_shape = tuple(input_shape)
+        self.M, self.N = M, N
+        assert n_measurements <= M*N, "The number of measurements must not exceed M*N"
+
+        rows = hadamard_ordering(M*N, ordering)[:n_measurements]
+        backward = partial(backward_hadamard_spc, image_size=(M, N))
+        super(HadamardSPC, self).__init__(learnable_optics=rows, sensing=forward_hadamard_spc, backward=backward)
+
+    def forward(self, x, type_calculation="forward"):
+        r"""
+        Forward propagation through the Hadamard SPC model.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+
+        Returns:
+            torch.Tensor: Output tensor after measurement of size (B, S, L) if type_calculation is "forward", (B, L, M, N) otherwise.
+        """
+        return super(HadamardSPC, self).forward(x, type_calculation)
+
+
+class SeparableSPC(BaseOpticsLayer):
+
+    r"""
+    Single Pixel Camera (SPC) with a separable (Kronecker) sensing matrix.
+
+    The patterns are outer products of the rows of two small matrices, :math:`\learnedOptics = \learnedOptics_r \otimes \learnedOptics_c`, so the measurements of each band are 
+
+    .. math::
+        \mathbf{Y}_{l} = \learnedOptics_r \mathbf{X}_{l} \learnedOptics_c^\top
+
+    with :math:`\learnedOptics_r \in \mathbb{R}^{S_r \times M}`, :math:`\learnedOptics_c \in \mathbb{R}^{S_c \times N}` and :math:`S = S_r S_c` measurements. 
+    
+    Only :math:`S_r M + S_c N` parameters are stored instead of :math:`S M N`, and the forward and backward operators are two matrix products per band.
+    """
+
+    def __init__(self, input_shape, n_measurements=(16, 16), trainable=False, initial_ca=None, **kwargs):
+        r"""
+
+        Args:
+            input_shape (tuple): Tuple, shape of the input image (L, M, N).
+            n_measurements (tuple): Number of measurements (S_r, S_c) along the rows and the columns.
+            trainable (bool): Boolean, if True the sensing matrices are trainable
+            initial_ca (tuple): Initial sensing matrices (H_r, H_c) with shapes (S_r, M) and (S_c, N)
+        """
+        _, M, N = input_shape
+        self.input_shape = tuple(input_shape)
+        self.trainable = trainable
+        self.initial_ca = initial_ca
+
+        if self.initial_ca is None:
+            initializer = [torch.randn((n_measurements[0], M)), torch.randn((n_measurements[1], N))]
+        else:
+            initializer = [torch.from_numpy(h).float() for h in self.initial_ca]
+
+        #Add parameters in pytorch manner
+        ca = torch.nn.ParameterList([torch.nn.Parameter(h, requires_grad=self.trainable) for h in initializer])
+        super(SeparableSPC, self).__init__(learnable_optics=ca, sensing=forward_separable_spc, backward=self._pinv_backward, adjoint=adjoint_separable_spc)
+
+    def forward(self, x, type_calculation="forward"):
+        r"""
+        Forward propagation through the separable SPC model.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+
+        Returns:
+            torch.Tensor: Output tensor after measurement of size (B, L, S_r, S_c) if type_calculation is "forward", (B, L, M, N) otherwise.
+        """
+        return super(SeparableSPC, self).forward(x, type_calculation)
+
+    def weights_reg(self, reg):
+        r"""
+        Regularization of the sensing matrices, the sum of the regularization of both factors.
+
+        Args:
+            reg (function): Regularization function.
+        
+        Returns:
+            torch.Tensor: Regularization value.
+        """
+        return sum(reg(h) for h in self.learnable_optics)
+
+    def gram(self, x):
+        r"""
+        Applies the Gram operator with the cached Gram matrices of the factors, two products with (M, M) and (N, N) matrices per band.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+
+        Returns:
+            torch.Tensor: Output tensor of size (B, L, M, N).
+        """
+        G = [self.cached(f"gram_{i}", lambda h: torch.matmul(h.t(), h), h) for i, h in enumerate(self.learnable_optics)]
+        return gram_separable_spc(x, self.learnable_optics, G=G)
+
+    def _pinv_backward(self, y, H):
+        Hinv = [self.cached(f"pinv_{i}", torch.linalg.pinv, h) for i, h in enumerate(H)]
+        return backward_separable_spc(y, H, Hinv=Hinv)
+
+
+class BlockSPC(BaseOpticsLayer):
+
+    r"""
+    Block-based Single Pixel Camera (SPC), also known as block compressive sensing.
+
+    The image is split into :math:`K` non-overlapping blocks of :math:`b \times b` pixels that are measured with the same sensing matrix :math:`\learnedOptics \in \mathbb{R}^{S \times b^2}`,
+
+    .. math::
+        \mathbf{y}_{l, s, k} = \sum_{p=1}^{b^2} \learnedOptics_{s, p} \mathbf{x}_{l, k, p}
+
+    where :math:`\mathbf{x}_{l, k}` is the k-th block of the l-th band. The cost and memory grow linearly with the image area, and all the blocks are measured with a single batched product.
+    """
+
+    def __init__(self, input_shape, block_size=32, n_measurements=256, trainable=False, initial_ca=None, **kwargs):
+        r"""
+
+        Args:
+            input_shape (tuple): Tuple, shape of the input image (L, M, N), M and N must be multiples of block_size.
+            block_size (int): Size b of the square blocks.
+            n_measurements (int): Number of measurements per block.
+            trainable (bool): Boolean, if True the coded aperture is trainable
+            initial_ca (torch.Tensor): Initial coded aperture with shape (S, b*b)
+        """
+        _, M, N = input_shape
+        self.input_shape = tuple(input_shape)
+        assert M % block_size == 0 and N % block_size == 0, f"the image size ({M}, {N}) should be a multiple of the block size {block_size}"
+        self.M, self.N = M, N
+        self.block_size = block_size
+        self.trainable = trainable
+        self.initial_ca = initial_ca
+
+        if self.initial_ca is None:
+            initializer = torch.randn((n_measurements, block_size**2), requires_grad=self.trainable)
+        else:
+            initializer = torch.from_numpy(self.initial_ca).float()
+
+        #Add parameter CA in pytorch manner
+        ca = torch.nn.Parameter(initializer, requires_grad=self.trainable)
+        adjoint = partial(adjoint_block_spc, image_size=(M, N))
+        super(BlockSPC, self).__init__(learnable_optics=ca, sensing=forward_block_spc, backward=self._pinv_backward, adjoint=adjoint, optics_grad=optics_grad_block_spc)
+
+    def forward(self, x, type_calculation="forward"):
+        r"""
+        Forward propagation through the block SPC model.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+
+        Returns:
+            torch.Tensor: Output tensor after measurement of size (B, L, S, K) if type_calculation is "forward", (B, L, M, N) otherwise.
+        """
+        return super(BlockSPC, self).forward(x, type_calculation)
+
+    def gram(self, x):
+        r"""
+        Applies the Gram operator, with the cached Gram matrix of the blocks when it is cheaper than the forward and adjoint operators.
+
+        Args:
+            x (torch.Tensor): Input image tensor of size (B, L, M, N).
+
+        Returns:
+            torch.Tensor: Output tensor of size (B, L, M, N).
+        """
+        H = self.learnable_optics
+        trained = H.requires_grad and torch.is_grad_enabled()
+        if trained or self.block_size ** 2 >= 2 * H.shape[0]:
+            return super(BlockSPC, self).gram(x)
+        return gram_block_spc(x, H, G=self.cached("gram", lambda H: torch.matmul(H.t(), H)))
+
+    def _pinv_backward(self, y, H):
+        Hinv = self.cached("pinv", torch.linalg.pinv, H)
+        return backward_block_spc(y, H, image_size=(self.M, self.N), Hinv=Hinv)
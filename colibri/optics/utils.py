@@ -1,11 +1,28 @@
+import os
 import torch
+from .functional import LinearOperatorFunction, accumulation_dtype
+
+
 class BaseOpticsLayer(torch.nn.Module):
 
     r"""
     Base class for CASSI systems.
     """
 
-    def __init__(self, learnable_optics, sensing, backward):
+    #: If True, the rows of the image are independent through the operators, so they can be processed in chunks.
+    row_separable = False
+
+    #: Number of dimensions of a single optical element, the optics may then have an extra leading dimension with a batch of K elements 
+    #: whose measurements are stacked along the batch. None if the layer does not support batches of optics.
+    optics_ndim = None
+
+    #: If True, the operators accept boolean optics, so the optics can be frozen as a binary mask with :meth:`binarize`.
+    binary_optics = False
+
+    #: Storage dtype of the inputs and the optics set with :meth:`set_precision`, None keeps the dtype of the inputs.
+    precision = None
+
+    def __init__(self, learnable_optics, sensing, backward, adjoint=None, optics_grad=None):
         r"""
         Initializes the BaseOpticsLayer layer.
 
@@ -13,16 +30,28 @@ class BaseOpticsLayer(torch.nn.Module):
             learnable_optics (torch.Tensor): Coded aperture 
             sensing (function): Sensing function.
             backward (function): Backward function.
+            adjoint (function): Adjoint of the sensing function, if None the backward function is used.
+            optics_grad (function): Gradient of :math:`\langle \forwardLinear_{\learnedOptics}(\mathbf{x}), \mathbf{y} \rangle` with respect to the optics. 
+                If given, the sensing and adjoint functions run as a :class:`colibri.optics.functional.LinearOperatorFunction`, which differentiates them analytically and only keeps their inputs for the backward pass.
         """
         super(BaseOpticsLayer, self).__init__()
-        self.learnable_optics = learnable_optics
+        if isinstance(learnable_optics, torch.Tensor) and not isinstance(learnable_optics, torch.nn.Parameter):
+            # Fixed optics, e.g. pattern indices, still follow the layer across devices and checkpoints
+            self.register_buffer("learnable_optics", learnable_optics)
+        else:
+            self.learnable_optics = learnable_optics
         self.sensing = sensing
         self.backward = backward
+        self.adjoint = backward if adjoint is None else adjoint
+        self.optics_grad = optics_grad
+        self._cache = {}
 
     def forward(self, x, type_calculation="forward"):
         r"""
         Performs the forward or backward operator according to the type_calculation
 
+        This is a thin dispatch over :meth:`forward_operator`, :meth:`backward_operator` and :meth:`gram`, which can be called, or compiled with ``torch.compile``, directly.
+
         Args:
             x (torch.Tensor): Input tensor 
             type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
@@ -31,19 +60,350 @@ class BaseOpticsLayer(torch.nn.Module):
         Raises:
             ValueError: If type_calculation is not "forward", "backward" or "forward_backward"
         """
+        if self.precision is not None:
+            x = x.to(self.precision)
 
         if type_calculation == "forward":
-            return self.sensing(x, self.learnable_optics)
+            return self.forward_operator(x)
 
         elif type_calculation == "backward":
-            return self.backward(x, self.learnable_optics)
+            return self.backward_operator(x)
         elif type_calculation == "forward_backward":
-            return self.backward(self.sensing(x, self.learnable_optics), self.learnable_optics)
+            if self.backward is self.adjoint:
+                return self.gram(x)
+            return self.backward_operator(self.forward_operator(x))
 
         else:
             raise ValueError("type_calculation must be forward, backward or forward_backward")
+
+    def forward_operator(self, x, optics=None):
+        r"""
+        Applies the sensing model :math:`\forwardLinear_{\learnedOptics}`.
+
+        Args:
+            x (torch.Tensor): Input tensor
+            optics (torch.Tensor): Optics, if None the learnable optics are used.
+        Returns:
+            torch.Tensor: Measurements
+        """
+        optics = self.learnable_optics if optics is None else optics
+        if self.optics_grad is None or not _requires_grad(x, optics):
+            return self.sensing(x, optics)
+        return LinearOperatorFunction.apply(x, optics, self.sensing, self.adjoint, self.optics_grad)
+
+    def backward_operator(self, y, optics=None):
+        r"""
+        Applies the backward operator of the layer, e.g., the adjoint or a pseudo-inverse of the sensing model.
+
+        Args:
+            y (torch.Tensor): Measurements
+            optics (torch.Tensor): Optics, if None the learnable optics are used.
+        Returns:
+            torch.Tensor: Output tensor
+        """
+        # Only the adjoint can be differentiated with the sensing function, other backward functions (e.g. pseudo-inverses) use autograd
+        if self.backward is self.adjoint:
+            return self.adjoint_operator(y, optics)
+        return self.backward(y, self.learnable_optics if optics is None else optics)
+
+    def adjoint_operator(self, y, optics=None):
+        r"""
+        Applies the adjoint :math:`\forwardLinear_{\learnedOptics}^\top` of the sensing model.
+
+        Args:
+            y (torch.Tensor): Measurements
+            optics (torch.Tensor): Optics, if None the learnable optics are used.
+        Returns:
+            torch.Tensor: Output tensor
+        """
+        optics = self.learnable_optics if optics is None else optics
+        # With a batch of optics each measurement is back-projected by its own element, that is not the adjoint of the broadcast sensing function
+        if self.optics_grad is None or self.n_apertures(optics) > 1 or not _requires_grad(y, optics):
+            return self.adjoint(y, optics)
+        return LinearOperatorFunction.apply(y, optics, self.adjoint, self.sensing, self.optics_grad, True)
+
+    def to_sparse(self, transpose=False):
+        r"""
+        Builds the sensing model as a sparse CSR matrix directly from the optics, e.g., to precondition a solver or to export it to scipy.
+
+        The matrix maps each sample of the input, flattened in row-major order, to the flattened measurement. The matrices are cached until the optics change.
+        The matrices are an export of the operator, they are not differentiable with respect to the optics and their products are slower than the operators of the layer.
+
+        Args:
+            transpose (bool): If True, the transpose of the matrix, i.e., the adjoint operator, is returned.
+        Returns:
+            torch.Tensor: Sparse CSR matrix with shape (prod(measurement_shape), prod(input_shape)), or its transpose.
+        Raises:
+            ValueError: If the layer holds a batch of optics.
+            NotImplementedError: If the layer does not build a sparse matrix.
+        """
+        if type(self)._sparse_matrix is BaseOpticsLayer._sparse_matrix:
+            # Checked before the optics are read, they are not a single tensor in every layer
+            raise NotImplementedError(f"{type(self).__name__} does not build a sparse matrix")
+        if self.n_apertures() > 1:
+            raise ValueError("the sparse matrix of a batch of optics is not supported")
+
+        # The matrices are not differentiated, detaching the optics keeps them cached while the optics are trained
+        optics = self.learnable_optics.detach()
+        A = self.cached("sparse", lambda optics: self._sparse_matrix(optics if optics.is_floating_point() else optics.to(torch.get_default_dtype())), optics)
+        if transpose:
+            return self.cached("sparse_transpose", lambda optics: A.t().to_sparse_csr(), optics)
+        return A
+
+    def _sparse_matrix(self, optics):
+        # Sparse matrix of a single optical element, overridden by the layers that support :meth:`to_sparse`
+        raise NotImplementedError(f"{type(self).__name__} does not build a sparse matrix")
+
+    def set_precision(self, dtype):
+        r"""
+        Sets the precision in which the inputs and the optics are stored, e.g. torch.bfloat16 or torch.float16 to halve the memory of the spectral images.
+
+        The floating point optics are cast to the dtype and the inputs of :meth:`forward` are cast to it. 
+        With half precision, the reductions of the CASSI operators and the matrix products of SPC are accumulated in float32 (see :func:`colibri.optics.functional.accumulation_dtype`) and the outputs are stored in half precision.
+
+        Args:
+            dtype (torch.dtype): Storage dtype, if None the inputs keep their dtype.
+        Returns:
+            BaseOpticsLayer: The layer itself.
+        """
+        self.precision = dtype
+        if dtype is not None:
+            self._apply(lambda t: t.to(dtype) if t.is_floating_point() else t)
+        return self
+
+    def binarize(self, threshold=0.0):
+        r"""
+        Freezes the optics as a binary mask for inference.
+
+        The optics are thresholded and stored as a boolean buffer, which takes a quarter of the memory of float32 optics, 
+        and the operators multiply the input by the mask. The optics are no longer trainable.
+
+        Args:
+            threshold (float): Entries of the optics above the threshold are transmitted.
+        Returns:
+            BaseOpticsLayer: The layer itself.
+        Raises:
+            ValueError: If the operators of the layer do not accept boolean optics.
+        """
+        if not self.binary_optics:
+            raise ValueError(f"{type(self).__name__} does not support binary optics")
+
+        mask = self.learnable_optics.detach() > threshold
+        del self.learnable_optics
+        self.register_buffer("learnable_optics", mask)
+        self.trainable = False
+        return self
+
+    def n_apertures(self, optics=None):
+        r"""
+        Number of optical elements, e.g. coded apertures, in the batch of optics.
+
+        Args:
+            optics (torch.Tensor): Optics, if None the learnable optics are used.
+        Returns:
+            int: Number K of optical elements, the measurements of a batch of B samples have K*B samples grouped by element.
+        """
+        optics = self.learnable_optics if optics is None else optics
+        if self.optics_ndim is None or optics.dim() == self.optics_ndim:
+            return 1
+        return optics.shape[0]
+
+    def gram(self, x):
+        r"""
+        Applies the Gram operator :math:`\forwardLinear_{\learnedOptics}^\top\forwardLinear_{\learnedOptics}`, i.e., the adjoint of the sensing model after the sensing model.
+
+        Unlike ``type_calculation="forward_backward"``, the adjoint is always used, even if the backward operator is a pseudo-inverse. 
+        Layers whose Gram operator is cheaper to apply than the two operators, e.g. through a small precomputed Gram matrix, override this method.
+        With a batch of K optical elements, the Gram operator of each element is applied and the K*B outputs are grouped by element.
+
+        Args:
+            x (torch.Tensor): Input tensor 
+        Returns:
+            torch.Tensor: Output tensor with the shape of x, or K*B samples for a batch of optics
+        """
+        return self.adjoint_operator(self.forward_operator(x))
+
+    def stream(self, chunks, type_calculation="forward", chunk_rows=None):
+        r"""
+        Applies the operator to consecutive row-chunks of the input and yields the row-chunks of the output.
+
+        For row-separable systems such as CASSI, whose dispersion runs along the columns, the rows are independent, so the memory is bounded by the chunk size 
+        and inputs that do not fit in memory can be processed, e.g., from a memory-mapped array.
+
+        Args:
+            chunks (iterable or array): Iterable of consecutive row-chunks with shape (B, C, rows, W), or a tensor, numpy array or memory map with shape (B, C, M, W) that is read chunk_rows rows at a time.
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+            chunk_rows (int): Number of rows per chunk when chunks is an array.
+        Yields:
+            torch.Tensor: Consecutive row-chunks of the output.
+        Raises:
+            ValueError: If the layer is not row separable or the chunks have more rows than the optics.
+        """
+        if not self.row_separable:
+            raise ValueError(f"{type(self).__name__} is not separable across rows")
+
+        if hasattr(chunks, "shape"):
+            assert chunk_rows is not None, "chunk_rows must be given to split an array"
+            source = chunks
+            chunks = (source[..., i:i + chunk_rows, :] for i in range(0, source.shape[-2], chunk_rows))
+
+        optics = self.learnable_optics
+        # Half precision optics are iterated in float32, like their reductions, the transforms do not support half precision
+        dtype = accumulation_dtype(optics.dtype) if optics.is_floating_point() else torch.get_default_dtype()
+        row = 0
+        for chunk in chunks:
+            chunk = torch.as_tensor(chunk, dtype=dtype, device=optics.device)
+            n_rows = chunk.shape[-2]
+            if row + n_rows > optics.shape[-2]:
+                raise ValueError(f"the chunks have more rows than the optics ({optics.shape[-2]})")
+
+            chunk_optics = optics[..., row:row + n_rows, :]
+            if type_calculation == "forward":
+                yield self.forward_operator(chunk, chunk_optics)
+            elif type_calculation == "backward":
+                yield self.backward_operator(chunk, chunk_optics)
+            elif type_calculation == "forward_backward":
+                yield self.backward_operator(self.forward_operator(chunk, chunk_optics), chunk_optics)
+            else:
+                raise ValueError("type_calculation must be forward, backward or forward_backward")
+            row += n_rows
+
         
-        
+    def parallel(self, x, type_calculation="forward", num_workers=None, chunk_rows=None):
+        r"""
+        Applies the operator of a row-separable system with a pool of processes, each one computing a band of rows of the output.
+
+        The input, the optics and the output are placed in shared memory, so the workers read their rows and write their results in place without copying them. 
+        The computation runs on CPU and is not differentiable.
+
+        Args:
+            x (torch.Tensor): Input tensor with shape (B, C, M, W), its storage is moved to shared memory.
+            type_calculation (str): String, it can be "forward", "backward" or "forward_backward"
+            num_workers (int): Number of processes, if None the number of CPUs is used.
+            chunk_rows (int): Number of rows per task, if None the rows are split evenly among the workers.
+        Returns:
+            torch.Tensor: Output tensor.
+        Raises:
+            ValueError: If the layer is not row separable or type_calculation is not "forward", "backward" or "forward_backward"
+        """
+        if not self.row_separable:
+            raise ValueError(f"{type(self).__name__} is not separable across rows")
+        if type_calculation not in ["forward", "backward", "forward_backward"]:
+            raise ValueError("type_calculation must be forward, backward or forward_backward")
+
+        num_workers = os.cpu_count() if num_workers is None else num_workers
+        M = x.shape[-2]
+        chunk_rows = -(-M // num_workers) if chunk_rows is None else chunk_rows
+
+        x = x.detach().share_memory_()
+        optics = self.learnable_optics.detach().share_memory_()
+
+        # The output size along the columns and channels is read from a single row
+        with torch.no_grad():
+            row = _apply_operator(self.sensing, self.backward, type_calculation, x[..., :1, :], optics[..., :1, :])
+        out = torch.empty(*row.shape[:-2], M, row.shape[-1], dtype=row.dtype).share_memory_()
+
+        tasks = [(self.sensing, self.backward, type_calculation, x[..., i:i + chunk_rows, :], optics[..., i:i + chunk_rows, :], out[..., i:i + chunk_rows, :]) 
+                 for i in range(0, M, chunk_rows)]
+        num_threads = max(1, torch.get_num_threads() // num_workers)
+        with torch.multiprocessing.get_context().Pool(num_workers, initializer=torch.set_num_threads, initargs=(num_threads,)) as pool:
+            pool.starmap(_row_worker, tasks)
+
+        return out
+
+    def cached(self, name, fn, optics=None):
+        r"""
+        Evaluates a function of the optics, e.g., a factorization, and reuses the result while the optics are unchanged.
+
+        Results are keyed on the version counter, the storage and the view (shape, strides and offset) of the optics, so in-place updates such as optimizer steps, or moving the layer to another device, invalidate them.
+        Only the optics of the layer, or views of them, are cached, the results for other tensors are computed on every call.
+        If the optics require gradients and autograd is enabled, the result is recomputed on every call so that it remains differentiable, and under ``torch.compile`` it is computed inside the compiled graph.
+
+        Args:
+            name (str): Name of the cached result.
+            fn (function): Function of the optics.
+            optics (torch.Tensor or list): Tensor, or list of tensors, the result depends on, if None the learnable optics are used.
+        Returns:
+            Result of fn(optics).
+        """
+        optics = self.learnable_optics if optics is None else optics
+        if _is_compiling():
+            # The cache keys are Python bookkeeping that would break the compiled graph, the result is computed inside the graph instead
+            return fn(optics)
+        tensors = list(optics) if isinstance(optics, (list, tuple, torch.nn.ParameterList)) else [optics]
+
+        if any(t.requires_grad for t in tensors) and torch.is_grad_enabled():
+            return fn(optics)
+
+        key = self._cache_key(tensors)
+        if key is None:
+            return fn(optics)
+
+        entry = self._cache.get(name)
+        if entry is None or entry[0] != key:
+            with torch.no_grad():
+                entry = (key, fn(optics))
+            self._cache[name] = entry
+        return entry[1]
+
+    def _cache_key(self, tensors):
+        # The storage of a tensor of the layer is not reused while the layer holds it, the key of a tensor that is not a view of the optics would be ambiguous
+        owned = self.learnable_optics
+        owned = list(owned) if isinstance(owned, (list, tuple, torch.nn.ParameterList)) else [owned]
+        key = []
+        for t in tensors:
+            storage = t.untyped_storage().data_ptr()
+            owner = next((o for o in owned if o.device == t.device and o.untyped_storage().data_ptr() == storage), None)
+            if owner is None:
+                return None
+            key.append((id(owner), t._version, storage, tuple(t.shape), t.stride(), t.storage_offset(), t.dtype, t.device))
+        return tuple(key)
+
+    def operator_norm(self, transform=None, n_iter=100, n_vectors=4, tol=1e-5):
+        r"""
+        Estimates the spectral norm :math:`\|\forwardLinear_{\learnedOptics}\|_2` of the sensing model by power iteration on the Gram operator.
+
+        Its square is the Lipschitz constant of the gradient of :math:`\frac{1}{2}\|\forwardLinear_{\learnedOptics}(\mathbf{x}) - \mathbf{y}\|_2^2`, so :math:`1/\|\forwardLinear_{\learnedOptics}\|_2^2` is the largest safe step size of gradient-based solvers.
+        Several random vectors are iterated as a batch and the largest estimate is kept. The vectors are drawn from a generator with a fixed seed, so the estimate is deterministic and the global random state is not modified.
+        The result is cached for each type of transform, normalization and setting of the iterations until the optics change.
+
+        Args:
+            transform (object): Transform with forward and inverse methods, e.g. :class:`colibri.recovery.transforms.DCT2D`, if given the norm of :math:`\forwardLinear_{\learnedOptics} \circ \text{inverse}` is estimated. It should be orthonormal, otherwise the inverse is used in place of its adjoint.
+            n_iter (int): Maximum number of iterations.
+            n_vectors (int): Number of random vectors iterated at once.
+            tol (float): Relative change of the estimate at which the iterations stop.
+        Returns:
+            float: Estimate of the spectral norm.
+        """
+        with torch.no_grad():
+            key = None if transform is None else (type(transform), getattr(transform, "norm", None))
+            # The settings of the iterations are part of the key, a coarse estimate is not returned for a stricter request
+            return self.cached(("operator_norm", key, n_iter, n_vectors, tol), lambda optics: self._power_iteration(transform, n_iter, n_vectors, tol))
+
+    def _power_iteration(self, transform, n_iter, n_vectors, tol):
+        optics = next(iter(self.learnable_optics)) if isinstance(self.learnable_optics, torch.nn.ParameterList) else self.learnable_optics
+        # Half precision optics are iterated in float32, like their reductions, the transforms do not support half precision
+        dtype = accumulation_dtype(optics.dtype) if optics.is_floating_point() else torch.get_default_dtype()
+        generator = torch.Generator(device=optics.device).manual_seed(0)
+        v = torch.randn(n_vectors, *self.input_shape, dtype=dtype, device=optics.device, generator=generator)
+
+        eig = 0.0
+        for _ in range(n_iter):
+            v = v / v.flatten(1).norm(dim=1).clamp_min(1e-12).view(-1, *[1] * (v.dim() - 1))
+            w = self.gram(v) if transform is None else transform.forward(self.gram(transform.inverse(v)))
+            if w.shape[0] != v.shape[0]:
+                # Gram operator of the measurements stacked over a batch of optics
+                w = w.unflatten(0, (-1, v.shape[0])).sum(dim=0)
+            # Rayleigh quotient of the normalized vectors
+            new_eig = (v * w).flatten(1).sum(dim=1).max().item()
+            v = w
+            converged = abs(new_eig - eig) <= tol * new_eig
+            eig = new_eig
+            if converged:
+                break
+
+        return eig ** 0.5
+
     def weights_reg(self,reg):
         r"""
         Regularization of the coded aperture.
@@ -70,6 +430,30 @@ class BaseOpticsLayer(torch.nn.Module):
             torch.Tensor: Regularization value.
         """
 
-        y = self.sensing(x, self.learnable_optics)
+        y = self.forward_operator(x)
         reg_value = reg(y)
-        return reg_value
\ No newline at end of file
+        return reg_value
+
+
+def _is_compiling():
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling()
+
+
+def _requires_grad(x, optics):
+    # Without gradients the operators are called directly, which avoids the overhead of the autograd function and lets torch.compile trace through them
+    return torch.is_grad_enabled() and (x.requires_grad or optics.requires_grad)
+
+
+def _apply_operator(sensing, backward, type_calculation, x, optics):
+    if type_calculation == "forward":
+        return sensing(x, optics)
+    elif type_calculation == "backward":
+        return backward(x, optics)
+    return backward(sensing(x, optics), optics)
+
+
+def _row_worker(sensing, backward, type_calculation, x, optics, out):
+    # Runs in a worker process, x, optics and out are views of shared memory
+    with torch.no_grad():
+        out.copy_(_apply_operator(sensing, backward, type_calculation, x, optics))
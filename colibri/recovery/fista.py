@@ -1,6 +1,8 @@
 import torch
 from torch import nn
 
+from colibri.optics.functional import accumulation_dtype
+
 
 class Fista(nn.Module):
     r"""
@@ -22,7 +24,31 @@ class Fista(nn.Module):
         \mathbf{z}_{k+1} &=  \mathbf{x}_{k+1} + \frac{t_k-1}{t_{k+1}}( \mathbf{x}_{k} - \mathbf{x}_{k-1})
         \end{align*}
 
-    where :math:`\alpha` is the step size and :math:`f` is the fidelity term.
+    where :math:`\alpha` is the step size and :math:`f` is the fidelity term. If the step size is not given, it is set to :math:`1/\|\forwardLinear\|_2^2`, the inverse of the Lipschitz constant of :math:`\nabla f`, 
+    with the operator norm estimated by :meth:`colibri.optics.utils.BaseOpticsLayer.operator_norm`.
+
+    If the acquisition model has an adjoint operator and the transform is orthonormal, the gradient of the fidelity is evaluated directly with the adjoint, 
+    :math:`\nabla f(\mathbf{z}) = \text{forward}(\forwardLinear^\top(\forwardLinear(\text{inverse}(\mathbf{z})) - \mathbf{y}))`, and the iterations run without autograd. 
+    Otherwise the gradient is computed with autograd.
+
+    Every ``check_every`` iterations, the relative change :math:`\|\mathbf{x}_{k+1} - \mathbf{x}_k\|_2 / \|\mathbf{x}_k\|_2` of each sample is compared with the tolerance. 
+    The samples of the batch that converged are frozen and removed from the iterations, and the algorithm stops when all the samples converged. 
+    The relative changes and the objectives :math:`\frac{1}{2}\|\mathbf{y} - \forwardLinear(\text{inverse}(\mathbf{x}_{k+1}))\|_2^2 + \frac{\lambda}{\alpha}\|\mathbf{x}_{k+1}\|_1` of each sample at the checks 
+    are kept on the device during the iterations and stored in :attr:`history` at the end.
+
+    With the analytic gradient, the low-allocation mode updates preallocated buffers in place, i.e., the gradient step, the proximal step into the buffer of :math:`\mathbf{x}_{k-1}` and the momentum step :math:`\mathbf{z}_{k+1} = \text{lerp}(\mathbf{x}_{k+1}, \mathbf{x}_k, -\frac{t_k-1}{t_{k+1}})`, 
+    so only the forward and adjoint operators allocate memory in each iteration.
+
+    The momentum can be restarted adaptively [O'Donoghue and Candès, 2015], i.e., :math:`t_k` is reset to 1 for the samples where the momentum 
+    goes against the gradient mapping, :math:`(\mathbf{z}_k - \mathbf{x}_{k+1})^\top(\mathbf{x}_{k+1} - \mathbf{x}_k) > 0` ("gradient" scheme), 
+    or where the objective increases ("function" scheme, it costs an extra forward operator per iteration). 
+    With backtracking, the step size is divided by :math:`\eta` until :math:`f(\mathbf{x}_{k+1}) \leq f(\mathbf{z}_k) + \nabla f(\mathbf{z}_k)^\top(\mathbf{x}_{k+1} - \mathbf{z}_k) + \frac{1}{2\alpha}\|\mathbf{x}_{k+1} - \mathbf{z}_k\|_2^2`, 
+    up to a slack for the rounding of :math:`f`, and it is never reduced below :math:`1/\|\forwardLinear\|_2^2`, which always satisfies the condition. 
+    The Lipschitz estimate :math:`1/\alpha` accepted at the first iteration, far from the solution, is kept by the solver in :attr:`lipschitz` and used as the initial step size of the next calls until the optics of the acquisition model change. 
+    The threshold of the proximal step is scaled with the step size, so the regularization parameter :math:`\lambda` is the threshold at the step size "alpha" and the problem solved does not depend on the backtracking.
+
+    A regularization path is solved in a single run by giving a list of regularization parameters. The P candidates are sorted from large to small and stacked along the batch, 
+    so all the solutions are computed together with the same measurements and acquisition model, and returned stacked in that order.
 
     """
 
@@ -34,7 +60,10 @@ class Fista(nn.Module):
             fidelity (nn.Module): The fidelity term in the optimization problem. This is a function that measures the discrepancy between the data and the model prediction.
             prior (nn.Module): The prior term in the optimization problem. This is a function that encodes prior knowledge about the solution.
             acquistion_model (nn.Module): The acquisition model of the imaging system. This is a function that models the process of data acquisition in the imaging system.
-            algo_params (dict): A dictionary containing the parameters for the optimization algorithm. For example, it could contain the tolerance for the stopping criterion.
+            algo_params (dict): A dictionary containing the parameters for the optimization algorithm. For example, it could contain the tolerance for the stopping criterion. If "alpha" is missing or "auto", the step size is computed from the operator norm of the acquisition model.
+                "tol" is the relative change of the solution at which a sample is converged, None to run all the iterations, and "check_every" is the number of iterations between convergence checks (defaults to 10).
+                If "inplace" is True, the iterations run in the low-allocation mode when the gradient is analytic. "lambda" can be a list of regularization parameters to solve a regularization path.
+                "restart" can be None, "gradient" or "function" for the adaptive restart of the momentum, and if "backtracking" is True the step size "alpha" is the initial step of the backtracking, which divides it by "eta" (defaults to 2) until the sufficient decrease condition holds. "lambda" is the threshold at the step size "alpha".
             transform (object): The transform to be applied to the image. This is a function that transforms the image into a different domain, for example, the DCT domain.
 
         Returns:
@@ -49,7 +78,12 @@ class Fista(nn.Module):
         self.transform = transform
 
         self.H = lambda alpha: self.acquistion_model.forward(self.transform.inverse(alpha))
+        self.H_adjoint = self._adjoint_model()
         self.tol = algo_params["tol"]
+        self.history = None
+        self.lambdas = None
+        self._lipschitz = None
+        self._lipschitz_key = None
 
     def forward(self, y, x0=None, verbose=False):
         """Runs the FISTA algorithm to solve the optimization problem.
@@ -57,37 +91,182 @@ class Fista(nn.Module):
         Args:
             y (torch.Tensor): The data to be reconstructed.
             x0 (torch.Tensor, optional): The initial guess for the solution. Defaults to None.
+            verbose (bool, optional): If True, the fidelity is printed at every iteration. Defaults to False.
 
         Returns:
-            torch.Tensor: The reconstructed image.
+            torch.Tensor: The reconstructed image. The relative changes of the solution and the objectives at each convergence check are stored in :attr:`history`, 
+            a tensor with shape (n_checks, 2, B), with the relative changes in ``history[:, 0]`` and the objectives in ``history[:, 1]``, that is NaN for the samples already converged. 
+            For a regularization path, the images have shape (P, B, ...) and the regularization parameters sorted from large to small are stored in :attr:`lambdas`.
         """
 
         if x0 is None:
             x0 = torch.zeros_like(y)
 
+        alpha_ref = self.algo_params.get("alpha", "auto")
+        if alpha_ref == "auto":
+            alpha_ref = 1 / self.acquistion_model.operator_norm(self.transform) ** 2
+        alpha = alpha_ref
+        alpha_min = None
+        if self.algo_params.get("backtracking", False):
+            if self.lipschitz is not None:
+                # Step size accepted by the backtracking of a previous call
+                alpha = 1 / self.lipschitz
+            # The step 1/L of the operator norm satisfies the sufficient decrease condition, the backtracking stops there
+            operator_norm = getattr(self.acquistion_model, "operator_norm", None)
+            alpha_min = 0.0 if operator_norm is None else 1 / operator_norm(self.transform) ** 2
+
         x = x0
-        t = 1
+        _lambda = self.algo_params["lambda"]
+        n_lambdas = None
+        if torch.as_tensor(_lambda).dim() > 0:
+            # Regularization path, the candidates are stacked along the batch and share the measurements
+            self.lambdas = torch.as_tensor(_lambda, dtype=x.dtype, device=x.device).flatten().sort(descending=True).values
+            n_lambdas, B = self.lambdas.numel(), x.shape[0]
+            x = x.expand(n_lambdas, *x.shape).flatten(0, 1)
+            y = y.unflatten(0, (-1, 1, B)).expand(-1, n_lambdas, *[-1] * y.dim()).flatten(0, 2)
+            _lambda = self.lambdas.repeat_interleave(B)
+
+        # Without autograd in the gradient step the iterations do not need to track gradients
+        with torch.set_grad_enabled(self.H_adjoint is None and torch.is_grad_enabled()):
+            x = self._iterate(x, y, alpha, alpha_ref, alpha_min, _lambda, verbose)
+
+        x_hat = self.transform.inverse(x)
+        return x_hat if n_lambdas is None else x_hat.unflatten(0, (n_lambdas, -1))
+
+    @property
+    def lipschitz(self):
+        """float: Lipschitz estimate accepted by the backtracking, None if it has not been estimated for the current optics. Setting it to None discards it."""
+        return self._lipschitz if self._lipschitz_key == self._optics_key() else None
+
+    @lipschitz.setter
+    def lipschitz(self, value):
+        self._lipschitz, self._lipschitz_key = value, self._optics_key()
+
+    def _optics_key(self):
+        # Identity and version of the tensors of the acquisition model, which change when the optics are modified or replaced
+        module = self.acquistion_model if isinstance(self.acquistion_model, nn.Module) else nn.Module()
+        tensors = list(module.parameters()) + list(module.buffers())
+        return tuple((id(t), t._version) for t in tensors) + (type(self.transform), getattr(self.transform, "norm", None))
+
+    def _iterate(self, x, y, alpha, alpha_ref, alpha_min, _lambda, verbose):
+        check_every = self.algo_params.get("check_every", 10)
+        inplace = self.algo_params.get("inplace", False) and self.H_adjoint is not None
+        restart = self.algo_params.get("restart", None)
+        B = x.shape[0]
+        active = torch.arange(B, device=x.device)  # Indices of the samples that are still iterated
+        x_hat = torch.empty_like(x)
+        history = []
+
+        t = x.new_ones(B)  # Momentum of each sample, the samples restart independently
         z = x.clone()
+        if inplace:
+            # x and x_old swap their buffers at each iteration, x0 is not overwritten
+            x, x_old = x.clone(), torch.empty_like(x)
+        if restart == "function":
+            objective = x.new_full((B,), float("inf"))
 
         for i in range(self.algo_params["max_iter"]):
-            x_old = x.clone()
-            z_old = z.clone()
+            t_new = (1 + (1 + 4 * t**2).sqrt()) / 2
+            beta = (t - 1) / t_new
 
-            # gradient step
-            x = z - self.algo_params["alpha"] * self.fidelity.grad(z, y, self.H)
+            if inplace:
+                x, x_old = x_old, x
+            else:
+                x_old = x
 
-            # proximal step
-            x = self.prior.prox(x, self.algo_params["lambda"])
+            # gradient and proximal steps
+            x, alpha = self._proximal_gradient(z, y, alpha, alpha_ref, _lambda, out=x if inplace else None, alpha_min=alpha_min)
+            if alpha_min is not None and i == 0:
+                # The estimate of the first step is kept for the next calls, near the solution the decrease is at the rounding level and does not measure the curvature
+                self.lipschitz = 1 / alpha
+
+            # adaptive restart, the momentum of the samples that restart is reset
+            if restart is not None:
+                with torch.no_grad():
+                    if restart == "gradient":
+                        reset = ((z - x) * (x - x_old)).flatten(1).sum(dim=1) > 0
+                    else:
+                        # The threshold lambda at the step alpha_ref is the proximal operator of (lambda / alpha_ref)||x||_1
+                        new_objective = self._objective(x, y, _lambda / alpha_ref)
+                        reset = new_objective > objective
+                        objective = new_objective
+                beta = torch.where(reset, torch.zeros_like(beta), beta)
+                t_new = torch.where(reset, torch.ones_like(t_new), t_new)
+            t = t_new
 
             # FISTA step
-            t_old = t
-            t = (1 + (1 + 4 * t_old**2) ** 0.5) / 2
-            z = x + ((t_old - 1) / t) * (x - x_old)
+            beta = beta.view(-1, *[1] * (x.dim() - 1))
+            if inplace:
+                torch.lerp(x, x_old, -beta, out=z)
+            else:
+                z = x + beta * (x - x_old)
 
-            error = self.fidelity.forward(x, y, self.H).item()
-            
             if verbose:
+                error = self.fidelity.forward(x, y, self.H).item()
                 print("Iter: ", i, "fidelity: ", error)
 
-        x_hat = self.transform.inverse(x)
+            if self.tol is None or (i + 1) % check_every != 0:
+                continue
+
+            with torch.no_grad():
+                change = (x - x_old).flatten(1).norm(dim=1) / x_old.flatten(1).norm(dim=1).clamp_min(1e-12)
+                objective_check = self._objective(x, y, _lambda / alpha_ref)
+                history.append(x.new_full((2, B), float("nan")).index_copy_(1, active, torch.stack([change, objective_check])))
+                converged = change <= self.tol
+
+            # A single synchronization every check_every iterations
+            if converged.any():
+                x_hat[active[converged]] = x[converged]
+                keep = ~converged
+                active = active[keep]
+                x, x_old, z, y, t = x[keep], x_old[keep], z[keep], _select_samples(y, keep), t[keep]
+                if torch.is_tensor(_lambda) and _lambda.dim() > 0:
+                    _lambda = _lambda[keep]
+                if restart == "function":
+                    objective = objective[keep]
+                if active.numel() == 0:
+                    break
+
+        x_hat[active] = x
+        self.history = torch.stack(history).cpu() if history else torch.empty(0, 2, B)
         return x_hat
+
+    def _proximal_gradient(self, z, y, alpha, alpha_ref, _lambda, out=None, alpha_min=None):
+        # Proximal gradient step from z, the step size is returned as the backtracking down to alpha_min may reduce it, None without backtracking
+        grad = self.fidelity.grad(z, y, self.H, H_adjoint=self.H_adjoint)
+        if alpha_min is None:
+            if out is not None:
+                # The gradient is a new tensor owned by the iteration, the gradient step is written over it
+                return self.prior.prox(torch.add(z, grad, alpha=-alpha, out=grad), _lambda, out=out), alpha
+            return self.prior.prox(z - alpha * grad, _lambda), alpha
+
+        # The step is reduced until the quadratic upper bound of the fidelity at z holds at the new point
+        eta = self.algo_params.get("eta", 2.0)
+        fidelity = self.fidelity.forward(z, y, self.H)
+        # Slack for the rounding of the fidelity, without it the condition fails on rounding noise near the solution
+        slack = 10 * torch.finfo(z.dtype).eps * abs(fidelity)
+        while True:
+            x = self.prior.prox(z - alpha * grad, _lambda * (alpha / alpha_ref), out=out)
+            d = x - z
+            if alpha <= alpha_min or self.fidelity.forward(x, y, self.H) <= fidelity + (grad * d).sum() + (d * d).sum() / (2 * alpha) + slack:
+                return x, alpha
+            alpha = max(alpha / eta, alpha_min)
+
+    def _objective(self, x, y, _lambda):
+        # Objective of each sample, the residuals of a batch of optical elements are grouped by element
+        residual = (self.H(x) - y).unflatten(0, (-1, x.shape[0])).transpose(0, 1).flatten(1)
+        return residual.pow(2).sum(dim=1) / 2 + _lambda * x.abs().flatten(1).sum(dim=1)
+
+    def _adjoint_model(self):
+        # Adjoint of the acquisition model composed with the inverse transform, None if the gradient needs autograd
+        adjoint_operator = getattr(self.acquistion_model, "adjoint_operator", None)
+        if adjoint_operator is None or not getattr(self.transform, "orthonormal", False):
+            return None
+        # The back-projection of a half precision layer is stored in half precision, it is cast to the dtype in which the layer accumulates, i.e. that of the iterates
+        return lambda residual: self.transform.forward(adjoint_operator(residual).to(accumulation_dtype(residual.dtype)))
+
+
+def _select_samples(y, keep):
+    # The measurements of a batch of K optical elements are grouped by element, the samples are selected within each group
+    K = y.shape[0] // keep.shape[0]
+    return y.unflatten(0, (K, -1))[:, keep].flatten(0, 1)
@@ -28,21 +28,28 @@ class L2(torch.nn.Module):
 
         return 1/2*torch.norm( H(x) - y,p=2)**2
     
-    def grad(self, x, y, H=None, transform=None):
+    def grad(self, x, y, H=None, transform=None, H_adjoint=None):
         r'''
-        Compute the gradient of the L1 fidelity term.
+        Compute the gradient of the L2 fidelity term.
 
         .. math::
-            \nabla f(\mathbf{x}) = \nabla \frac{1}{2}||\forwardLinear(\mathbf{x}) - \mathbf{y}||^2_2
+            \nabla f(\mathbf{x}) = \forwardLinear^\top(\forwardLinear(\mathbf{x}) - \mathbf{y})
+
+        If the adjoint of the forward model is given, the gradient is evaluated directly without gradients, otherwise it is computed with autograd.
 
         Args:
             x (torch.Tensor): Input tensor.
             y (torch.Tensor): Measurements tensor.
             H (function): Forward model.   
+            H_adjoint (function, optional): Adjoint of the forward model. Defaults to None.
 
         Returns:
-            torch.Tensor: Gradient of the L1 fidelity term. 
+            torch.Tensor: Gradient of the L2 fidelity term. 
         '''
+        if H_adjoint is not None:
+            with torch.no_grad():
+                return _sum_apertures(H_adjoint(H(x) - y), x)
+
         x = x.requires_grad_()
         return torch.autograd.grad(self.forward(x,y, H), x, create_graph=True)[0]
 
@@ -72,28 +79,36 @@ class L1(torch.nn.Module):
         
         return torch.norm( H(x) - y,p=1)
     
-    def grad(self, x, y, H):
+    def grad(self, x, y, H, H_adjoint=None):
         r'''
         Compute the gradient of the L1 fidelity term.
 
         .. math::
-            \nabla f(\mathbf{x}) = \nabla \frac{1}{2}||\forwardLinear(\mathbf{x}) - \mathbf{y}||_1
+            \nabla f(\mathbf{x}) = \forwardLinear^\top \text{sign}(\forwardLinear(\mathbf{x}) - \mathbf{y})
             
 
+        If the adjoint of the forward model is given, the gradient is evaluated directly without gradients, otherwise it is computed with autograd.
+
         Args:
             x (torch.Tensor): Input tensor.
             y (torch.Tensor): Measurements tensor.
             H (function): Forward model.   
+            H_adjoint (function, optional): Adjoint of the forward model. Defaults to None.
 
         Returns:
             torch.Tensor: Gradient of the L1 fidelity term. 
         '''
+        if H_adjoint is not None:
+            with torch.no_grad():
+                return _sum_apertures(H_adjoint(torch.sign(H(x) - y)), x)
+
         x = x.requires_grad_()
 
         return torch.autograd.grad(self.forward(x,y, H), x, create_graph=True)[0]
-    
-
-
-        
 
 
+def _sum_apertures(grad, x):
+    # With a batch of K optical elements the measurements of each sample are stacked K times, their back-projections are summed
+    if grad.shape[0] != x.shape[0]:
+        grad = grad.unflatten(0, (-1, x.shape[0])).sum(dim=0)
+    return grad
@@ -32,27 +32,32 @@ class Sparsity(torch.nn.Module):
         '''
         return torch.norm(x,1)**2
     
-    def prox(self, x, _lambda, type="soft"):
+    def prox(self, x, _lambda, type="soft", out=None):
         '''
         Compute proximal operator of the sparsity term.
 
         Args:
             x (torch.Tensor): Input tensor.
-            _lambda (float): Regularization parameter.
+            _lambda (float or torch.Tensor): Regularization parameter, or a vector with one regularization parameter per sample of x.
             type (str): String, it can be "soft" or "hard".
+            out (torch.Tensor): Optional tensor, not overlapping with x, where the result is written in place without gradients.
         
         Returns:
             torch.Tensor: Proximal operator of the sparsity term.
         '''
+        if torch.is_tensor(_lambda) and _lambda.dim() == 1:
+            _lambda = _lambda.view(-1, *[1] * (x.dim() - 1))
+
+        if out is not None:
+            with torch.no_grad():
+                if type == 'soft':
+                    return torch.abs(x, out=out).sub_(_lambda).clamp_(min=0).copysign_(x)
+                elif type == 'hard':
+                    return torch.mul(x, torch.abs(x) > _lambda, out=out)
+
         x = x.requires_grad_()
 
         if type == 'soft':
             return torch.sign(x)*torch.max(torch.abs(x) - _lambda, torch.zeros_like(x))
         elif type == 'hard':
             return x*(torch.abs(x) > _lambda)
-        
-        
-    
-
-    
-
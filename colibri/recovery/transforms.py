@@ -28,6 +28,11 @@ class DCT2D:
 
         self.norm = norm
 
+    @property
+    def orthonormal(self):
+        """bool: True if the transform is orthonormal, so its forward transform is the adjoint of its inverse."""
+        return self.norm == 'ortho'
+
     def forward(self, x):
         """Computes the 2D DCT of the input image.
 
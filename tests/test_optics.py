@@ -4,8 +4,11 @@ include_colibri()
 
 
 import torch
-from colibri.optics.cassi import SD_CASSI, DD_CASSI, C_CASSI
-from colibri.optics.spc import SPC
+from colibri.optics.cassi import SD_CASSI, DD_CASSI, C_CASSI, MultiShotCASSI
+from colibri.optics.functional import prism_operator, forward_sd_cassi, backward_sd_cassi, forward_dd_cassi, backward_dd_cassi, forward_color_cassi, backward_color_cassi
+from colibri.optics.functional import LinearOperatorFunction, forward_spc, backward_spc, adjoint_spc, fwht, hadamard_ordering
+from colibri.optics.spc import SPC, HadamardSPC, SeparableSPC, BlockSPC
+from colibri.optics.doe import DOE
 
 @pytest.fixture
 def imsize():
@@ -29,17 +32,19 @@ def cassi_config(imsize, mode):
 
 mode_list = ["sd_cassi", "dd", "color"]
 
+layers = {"sd_cassi": SD_CASSI, "dd": DD_CASSI, "color": C_CASSI, "spc": SPC, "separable_spc": SeparableSPC, "block_spc": BlockSPC}
+
+def make_layer(mode, input_shape, **kwargs):
+    # The arguments of the SPC layers are dropped for the CASSI layers, so one call builds every mode
+    if mode in mode_list:
+        kwargs = {key: value for key, value in kwargs.items() if key not in ("n_measurements", "backward_method")}
+    return layers[mode](input_shape, **kwargs)
+
 @pytest.mark.parametrize("mode", mode_list)
 def test_cassi(mode, imsize):
     cube = torch.randn(imsize)
     out_shape = cassi_config(imsize, mode)
-
-    if mode == "sd_cassi":
-        cassi = SD_CASSI(imsize[1:])
-    elif mode == "dd":
-        cassi = DD_CASSI(imsize[1:])
-    elif mode == "color":
-        cassi = C_CASSI(imsize[1:])
+    cassi = make_layer(mode, imsize[1:])
 
     cube = cube.float()
     measurement = cassi(cube, type_calculation="forward")
@@ -50,6 +55,98 @@ def test_cassi(mode, imsize):
     assert forward_backward.shape == cube.shape
 
 
+@pytest.mark.parametrize("mode", mode_list)
+def test_cassi_stream(mode, imsize):
+    cube = torch.randn(imsize)
+    cassi = make_layer(mode, imsize[1:])
+
+    with torch.no_grad():
+        measurement = cassi(cube, type_calculation="forward")
+        chunks = torch.split(cube, 5, dim=2)
+        streamed = torch.cat(list(cassi.stream(chunks, type_calculation="forward")), dim=2)
+        assert torch.allclose(streamed, measurement)
+
+        streamed = torch.cat(list(cassi.stream(measurement, type_calculation="backward", chunk_rows=7)), dim=2)
+        assert torch.allclose(streamed, cassi(measurement, type_calculation="backward"))
+
+
+def test_cassi_parallel(imsize):
+    cube = torch.randn(imsize)
+    cassi = SD_CASSI(imsize[1:])
+
+    with torch.no_grad():
+        measurement = cassi(cube, type_calculation="forward")
+        assert torch.allclose(cassi.parallel(cube, type_calculation="forward", num_workers=2), measurement)
+        assert torch.allclose(cassi.parallel(measurement, type_calculation="backward", num_workers=2, chunk_rows=5), cassi(measurement, type_calculation="backward"))
+
+
+@pytest.mark.parametrize("shift_sign", [1, -1])
+@pytest.mark.parametrize("n_bands", [31, 1])
+def test_prism_operator(shift_sign, n_bands, imsize):
+    b, _, M, N = imsize
+    L = n_bands
+    cube = torch.randn(b, L, M, N)
+
+    # Per-band reference implementation
+    bands = torch.unbind(cube, dim=1)
+    if shift_sign == 1:
+        bands = [torch.nn.functional.pad(bands[l], (l, L - l - 1)) for l in range(L)]
+    else:
+        bands = [bands[l][:, :, l:N - (L - 1) + l] for l in range(L)]
+    expected = torch.stack(bands, dim=1)
+
+    assert torch.equal(prism_operator(cube, shift_sign), expected)
+
+
+@pytest.mark.parametrize("mode", mode_list)
+def test_cassi_adjoint(mode, imsize):
+    b, c, h, w = imsize
+    x = torch.randn(imsize, dtype=torch.float64)
+
+    if mode == "sd_cassi":
+        ca = torch.randn(1, 1, h, w, dtype=torch.float64)
+        forward, backward = forward_sd_cassi, backward_sd_cassi
+    elif mode == "dd":
+        ca = torch.randn(1, 1, h, w + c - 1, dtype=torch.float64)
+        forward, backward = forward_dd_cassi, backward_dd_cassi
+    elif mode == "color":
+        ca = torch.randn(1, c, h, w, dtype=torch.float64)
+        forward, backward = forward_color_cassi, backward_color_cassi
+
+    y = torch.randn(cassi_config(imsize, mode), dtype=torch.float64)
+
+    # <A x, y> == <x, A^T y>
+    assert torch.allclose((forward(x, ca) * y).sum(), (x * backward(y, ca)).sum())
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc", "block_spc"])
+def test_optics_gradcheck(mode):
+    input_shape = (3, 6, 5)
+
+    if mode == "block_spc":
+        input_shape = (3, 6, 4)
+        optics_layer = make_layer(mode, input_shape, block_size=2, n_measurements=3, trainable=True)
+    else:
+        optics_layer = make_layer(mode, input_shape, n_measurements=8, trainable=True)
+
+    optics_layer = optics_layer.double()
+    x = torch.randn(2, *input_shape, dtype=torch.float64, requires_grad=True)
+    ca = optics_layer.learnable_optics
+
+    def forward(x, ca):
+        return LinearOperatorFunction.apply(x, ca, optics_layer.sensing, optics_layer.adjoint, optics_layer.optics_grad)
+
+    assert torch.autograd.gradcheck(forward, (x, ca))
+
+    if mode not in ["spc", "block_spc"]:
+        y = torch.randn_like(optics_layer(x), requires_grad=True)
+
+        def adjoint(y, ca):
+            return LinearOperatorFunction.apply(y, ca, optics_layer.adjoint, optics_layer.sensing, optics_layer.optics_grad, True)
+
+        assert torch.autograd.gradcheck(adjoint, (y, ca))
+
+
 @pytest.fixture
 def spc_config():
     img_size = [128, 32, 32]
@@ -65,4 +162,355 @@ def test_spc_forward(spc_config):
 
     y_forward = spc(x, type_calculation="forward")
     expected_shape = (b, n_measurements, c) 
-    assert y_forward.shape == expected_shape, "Forward output shape is incorrect"
\ No newline at end of file
+    assert y_forward.shape == expected_shape, "Forward output shape is incorrect"
+
+
+def test_spc_forward_layouts(spc_config):
+    img_size, n_measurements = spc_config
+    H = torch.randn(n_measurements, img_size[1] * img_size[2])
+    x = torch.randn(4, *img_size)
+
+    # Reference with one copy of H per sample
+    expected = torch.bmm(H.unsqueeze(0).repeat(4, 1, 1), x.reshape(4, img_size[0], -1).permute(0, 2, 1))
+
+    assert torch.allclose(forward_spc(x, H), expected, atol=1e-4)
+    assert torch.allclose(forward_spc(x.to(memory_format=torch.channels_last), H), expected, atol=1e-4)
+
+    out = torch.empty_like(expected)
+    assert forward_spc(x, H, out=out) is out
+    assert torch.allclose(out, expected, atol=1e-4)
+
+@pytest.mark.parametrize("backward_method", ["pinv", "lstsq", "transpose"])
+def test_spc_backward(backward_method):
+    img_size = [3, 8, 6]
+    spc = SPC(img_size, n_measurements=16, backward_method=backward_method).double()
+    reference = SPC(img_size, n_measurements=16).double()
+    reference.learnable_optics.data.copy_(spc.learnable_optics)
+
+    x = torch.randn(2, *img_size, dtype=torch.float64)
+    y = spc(x, type_calculation="forward")
+    x_hat = spc(y, type_calculation="backward")
+    assert x_hat.shape == x.shape
+
+    if backward_method == "lstsq":
+        assert torch.allclose(x_hat, reference(y, type_calculation="backward"))
+    elif backward_method == "transpose":
+        assert torch.allclose((y * y).sum(), (x * x_hat).sum())
+
+
+def test_spc_cached_pinv():
+    spc = SPC([3, 8, 8], n_measurements=16)
+    pinv = spc.cached("pinv", torch.linalg.pinv)
+    assert spc.cached("pinv", torch.linalg.pinv) is pinv
+
+    # In-place updates of the coded aperture invalidate the cache
+    with torch.no_grad():
+        spc.learnable_optics.mul_(2)
+    assert torch.allclose(spc.cached("pinv", torch.linalg.pinv), pinv / 2, atol=1e-5)
+
+    # Optics given by the caller are not cached, even if a new matrix reuses the memory of a freed one
+    y = torch.randn(2, 16, 3)
+    for _ in range(5):
+        H = torch.randn(16, 64)
+        assert torch.allclose(spc.backward_operator(y, optics=H), backward_spc(y, H, image_size=(8, 8)), atol=1e-4)
+
+
+def test_fwht():
+    n = 16
+    hadamard = torch.ones(1, 1, dtype=torch.float64)
+    while hadamard.shape[0] < n:
+        hadamard = torch.cat([torch.cat([hadamard, hadamard], 1), torch.cat([hadamard, -hadamard], 1)], 0)
+
+    x = torch.randn(3, n, dtype=torch.float64)
+    assert torch.allclose(fwht(x), x @ hadamard.t() / n ** 0.5)
+
+    # Walsh functions in sequency order have k sign changes
+    walsh = hadamard[hadamard_ordering(n, "sequency")]
+    sign_changes = (walsh[:, 1:] != walsh[:, :-1]).sum(dim=1)
+    assert torch.equal(sign_changes, torch.arange(n))
+
+
+@pytest.mark.parametrize("ordering", ["natural", "sequency", "random"])
+def test_hadamard_spc(ordering):
+    img_size = [3, 8, 4]
+    x = torch.randn(2, *img_size, dtype=torch.float64)
+
+    spc = HadamardSPC(img_size, n_measurements=12, ordering=ordering)
+    y = spc(x, type_calculation="forward")
+    assert y.shape == (2, 12, 3)
+
+    # <A x, y> == <x, A^T y>
+    y_rand = torch.randn_like(y)
+    assert torch.allclose((y * y_rand).sum(), (x * spc(y_rand, type_calculation="backward")).sum())
+
+    # With all the rows the acquisition is orthonormal
+    spc = HadamardSPC(img_size, n_measurements=32, ordering=ordering)
+    assert torch.allclose(spc(x, type_calculation="forward_backward"), x)
+
+
+def test_separable_spc():
+    img_size = [3, 8, 6]
+    spc = SeparableSPC(img_size, n_measurements=(4, 5), trainable=True).double()
+    H_rows, H_cols = spc.learnable_optics
+    H = torch.kron(H_rows, H_cols).detach()
+
+    x = torch.randn(2, *img_size, dtype=torch.float64)
+    y = spc(x, type_calculation="forward")
+    assert y.shape == (2, 3, 4, 5)
+
+    # Same measurements and reconstruction as the dense Kronecker matrix
+    y_dense = forward_spc(x, H)
+    assert torch.allclose(y.flatten(2).permute(0, 2, 1), y_dense)
+    assert torch.allclose(spc(y, type_calculation="backward"), backward_spc(y_dense, H, image_size=(8, 6)))
+
+    reg = spc.weights_reg(lambda h: h.pow(2).sum())
+    reg.backward()
+    assert all(h.grad is not None for h in spc.learnable_optics)
+
+
+def test_block_spc():
+    img_size = [3, 8, 12]
+    x = torch.randn(2, *img_size, dtype=torch.float64)
+
+    spc = BlockSPC(img_size, block_size=4, n_measurements=10).double()
+    y = spc(x, type_calculation="forward")
+    assert y.shape == (2, 3, 10, 6)
+    assert spc(y, type_calculation="backward").shape == x.shape
+
+    # Measuring a single block is the dense SPC model
+    block = x[..., :4, :4]
+    assert torch.allclose(y[..., 0].permute(0, 2, 1), forward_spc(block, spc.learnable_optics))
+
+    # With a full rank square matrix every block is recovered
+    spc = BlockSPC(img_size, block_size=4, n_measurements=16).double()
+    assert torch.allclose(spc(x, type_calculation="forward_backward"), x)
+
+
+@pytest.mark.parametrize("layer", ["sd_cassi", "spc", "separable_spc", "block_spc"])
+def test_gram(layer):
+    img_size = [3, 8, 8]
+    kwargs = {"sd_cassi": {}, "spc": {"n_measurements": 40}, "separable_spc": {"n_measurements": (5, 6)}, "block_spc": {"block_size": 4, "n_measurements": 10}}[layer]
+    optics = make_layer(layer, img_size, **kwargs).double()
+
+    x = torch.randn(2, *img_size, dtype=torch.float64)
+    expected = optics.adjoint(optics.sensing(x, optics.learnable_optics), optics.learnable_optics)
+    assert torch.allclose(optics.gram(x), expected)
+
+
+def test_operator_norm():
+    img_size = [2, 8, 8]
+    spc = SPC(img_size, n_measurements=20).double()
+    norm = spc.operator_norm(n_iter=500, tol=1e-10)
+    assert abs(norm - torch.linalg.matrix_norm(spc.learnable_optics, ord=2).item()) < 1e-6 * norm
+    assert spc.operator_norm(n_iter=500, tol=1e-10) == norm
+
+    # The estimate is recomputed when the coded aperture changes
+    with torch.no_grad():
+        spc.learnable_optics.mul_(2)
+    assert abs(spc.operator_norm() - 2 * norm) < 1e-3 * norm
+
+    # The estimate with a transform is shared by its instances and leaves the random state unchanged
+    from colibri.recovery.transforms import DCT2D
+    state = torch.get_rng_state()
+    norm_dct = spc.operator_norm(DCT2D())
+    assert torch.equal(torch.get_rng_state(), state)
+    assert spc.operator_norm(DCT2D()) == norm_dct
+    assert len([name for name in spc._cache if name[0] == "operator_norm" and name[1] is not None]) == 1
+
+    # A coarse estimate is not returned for a stricter request
+    spc.operator_norm(n_iter=1)
+    assert abs(spc.operator_norm(n_iter=500, tol=1e-10) - 2 * norm) < 1e-6 * norm
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc"])
+def test_batched_apertures(mode):
+    input_shape = (3, 6, 5)
+    K, B = 3, 2
+
+    optics_layer = make_layer(mode, input_shape, n_measurements=8, trainable=True, n_apertures=K, backward_method="transpose").double()
+    assert optics_layer.n_apertures() == K
+    x = torch.randn(B, *input_shape, dtype=torch.float64, requires_grad=True)
+    ca = optics_layer.learnable_optics
+
+    # Same measurements and back-projections as a loop over the apertures
+    y = optics_layer(x, type_calculation="forward")
+    y_loop = torch.cat([optics_layer.sensing(x, ca[k:k + 1] if mode != "spc" else ca[k]) for k in range(K)])
+    assert torch.allclose(y, y_loop)
+
+    x_loop = torch.cat([optics_layer.adjoint(y[k * B:(k + 1) * B], ca[k:k + 1] if mode != "spc" else ca[k]) for k in range(K)])
+    assert torch.allclose(optics_layer(y, type_calculation="backward"), x_loop)
+
+    def forward(x, ca):
+        return LinearOperatorFunction.apply(x, ca, optics_layer.sensing, optics_layer.adjoint, optics_layer.optics_grad)
+
+    assert torch.autograd.gradcheck(forward, (x, ca))
+
+
+@pytest.mark.parametrize("mode", ["sd", "dd", "color"])
+def test_multishot_cassi(mode):
+    input_shape = (4, 6, 5)
+    K = 3
+    x = torch.randn(2, *input_shape, dtype=torch.float64)
+
+    cassi = MultiShotCASSI(input_shape, n_shots=K, mode=mode).double()
+    single = {"sd": forward_sd_cassi, "dd": forward_dd_cassi, "color": forward_color_cassi}[mode]
+    ca = cassi.learnable_optics
+
+    # Same snapshots as K single-shot systems, stacked as channels
+    y = cassi(x, type_calculation="forward")
+    expected = torch.cat([single(x, ca[k:k + 1]) for k in range(K)], dim=1)
+    assert torch.allclose(y, expected)
+
+    # The backward operator is the adjoint of the stacked system
+    y = torch.randn_like(y)
+    assert torch.allclose((expected * y).sum(), (x * cassi(y, type_calculation="backward")).sum())
+
+    # The apertures of the row-chunks are not those cached for the whole image
+    y = cassi(x, type_calculation="forward")
+    assert torch.allclose(torch.cat(list(cassi.stream(x, chunk_rows=3)), dim=-2), y)
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc"])
+def test_sparse_operator(mode):
+    input_shape = (3, 6, 5)
+
+    optics_layer = make_layer(mode, input_shape, n_measurements=8, backward_method="transpose").double()
+    x = torch.randn(2, *input_shape, dtype=torch.float64)
+    y = optics_layer(x, type_calculation="forward")
+
+    A = optics_layer.to_sparse()
+    assert A.layout == torch.sparse_csr
+    assert torch.allclose(A.to_dense() @ x.reshape(2, -1).t(), y.reshape(2, -1).t())
+    assert torch.equal(optics_layer.to_sparse(transpose=True).to_dense(), A.to_dense().t())
+
+    x_adjoint = optics_layer(y, type_calculation="backward")
+    assert torch.allclose(optics_layer.to_sparse(transpose=True) @ y.reshape(2, -1).t(), x_adjoint.reshape(2, -1).t())
+
+
+def test_sparse_operator_not_implemented():
+    # The optics of a separable SPC are a list of matrices, the layer does not build a sparse matrix
+    with pytest.raises(NotImplementedError):
+        SeparableSPC((3, 8, 8), n_measurements=(4, 4)).to_sparse()
+
+
+def test_doe():
+    input_shape = (3, 10, 9)
+    doe = DOE(input_shape, wavelengths=[450e-9, 550e-9, 650e-9], pixel_size=2e-6, distance=1e-3, height_map_shape=(5, 4)).double()
+
+    psf = doe.get_psf()
+    assert psf.shape == (1, 3, 5, 4)
+    assert torch.allclose(psf.sum(dim=(-2, -1)), torch.ones(1, 3, dtype=torch.float64))
+
+    # Same as a direct "same" convolution of each band with its PSF
+    x = torch.randn(2, *input_shape, dtype=torch.float64)
+    y = doe(x, type_calculation="forward")
+    kernel = psf.permute(1, 0, 2, 3).flip(-2, -1)
+    padded = torch.nn.functional.pad(x, (1, 2, 2, 2))
+    assert torch.allclose(y, torch.nn.functional.conv2d(padded, kernel, groups=3))
+
+    # <A x, y> == <x, A^T y>
+    y = torch.randn_like(y)
+    assert torch.allclose((doe(x) * y).sum(), (x * doe(y, type_calculation="backward")).sum())
+
+    # The PSF spectrum is reused until the height map changes
+    spectrum = doe._spectrum(doe.learnable_optics)
+    assert doe._spectrum(doe.learnable_optics) is spectrum
+    with torch.no_grad():
+        doe.learnable_optics.add_(1e-7)
+    assert doe._spectrum(doe.learnable_optics) is not spectrum
+
+
+@pytest.mark.parametrize("tile_size", [4, (3, 5), 16])
+def test_tiled_convolution(tile_size):
+    input_shape = (2, 11, 13)
+    wavelengths = [500e-9, 600e-9]
+    doe = DOE(input_shape, wavelengths, pixel_size=2e-6, distance=1e-3, height_map_shape=(5, 6)).double()
+    tiled = DOE(input_shape, wavelengths, pixel_size=2e-6, distance=1e-3, height_map_shape=(5, 6), tile_size=tile_size).double()
+    tiled.learnable_optics.data.copy_(doe.learnable_optics)
+
+    x = torch.randn(3, *input_shape, dtype=torch.float64)
+    assert torch.allclose(tiled(x), doe(x))
+    assert torch.allclose(tiled(x, type_calculation="backward"), doe(x, type_calculation="backward"))
+
+
+@pytest.mark.parametrize("mode", mode_list)
+def test_binarize(mode, imsize):
+    cube = torch.randn(imsize)
+    cassi = make_layer(mode, imsize[1:], trainable=True)
+
+    with torch.no_grad():
+        binary_ca = (cassi.learnable_optics > 0).float()
+        measurement = cassi.sensing(cube, binary_ca)
+        backward = cassi.backward(measurement, binary_ca)
+
+    cassi.binarize()
+    assert cassi.learnable_optics.dtype == torch.bool
+    assert len(list(cassi.parameters())) == 0
+
+    # The mask and the product only differ by the summation order of the bands
+    assert torch.allclose(cassi(cube, type_calculation="forward"), measurement, atol=1e-5)
+    assert torch.allclose(cassi(measurement, type_calculation="backward"), backward, atol=1e-5)
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc"])
+def test_half_precision(mode):
+    input_shape = (16, 8, 8)
+    optics_layer = make_layer(mode, input_shape, n_measurements=32)
+
+    x = torch.rand(2, *input_shape)
+    y = optics_layer(x, type_calculation="forward")
+    x_hat = optics_layer(y, type_calculation="backward")
+    from colibri.recovery.transforms import DCT2D
+    norm = optics_layer.operator_norm(DCT2D())
+
+    optics_layer.set_precision(torch.bfloat16)
+    assert optics_layer.learnable_optics.dtype == torch.bfloat16
+
+    y_half = optics_layer(x, type_calculation="forward")
+    x_half = optics_layer(y_half, type_calculation="backward")
+    assert y_half.dtype == torch.bfloat16 and x_half.dtype == torch.bfloat16
+
+    # The error is that of the bfloat16 storage, not of a bfloat16 accumulation
+    assert torch.linalg.norm(y_half.float() - y) / torch.linalg.norm(y) < 2e-2
+    if mode != "spc":
+        assert torch.linalg.norm(x_half.float() - x_hat) / torch.linalg.norm(x_hat) < 2e-2
+
+    # The power iteration runs in float32, the transforms do not support half precision
+    assert abs(optics_layer.operator_norm(DCT2D()) - norm) < 1e-2 * norm
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc"])
+def test_scripted_operators(mode):
+    input_shape = (16, 8, 8)
+    optics_layer = make_layer(mode, input_shape, n_measurements=32, backward_method="transpose")
+
+    x = torch.rand(2, *input_shape)
+    optics = optics_layer.learnable_optics
+    y = optics_layer.forward_operator(x)
+    x_hat = optics_layer.adjoint_operator(y)
+    assert torch.allclose(y, optics_layer(x, type_calculation="forward"))
+    assert torch.allclose(x_hat, optics_layer(y, type_calculation="backward"))
+
+    sensing = torch.jit.script(optics_layer.sensing)
+    if mode == "spc":
+        scripted_adjoint = torch.jit.script(adjoint_spc)
+        adjoint = lambda y, H: scripted_adjoint(y, H, (8, 8))
+    else:
+        adjoint = torch.jit.script(optics_layer.adjoint)
+
+    assert torch.allclose(sensing(x, optics), y, atol=1e-6)
+    assert torch.allclose(adjoint(y, optics), x_hat, atol=1e-6)
+
+
+@pytest.mark.parametrize("mode", mode_list + ["spc"])
+def test_compiled_operators(mode):
+    input_shape = (16, 8, 8)
+    optics_layer = make_layer(mode, input_shape, n_measurements=32, backward_method="transpose")
+
+    x = torch.rand(2, *input_shape)
+    with torch.no_grad():
+        y = optics_layer.forward_operator(x)
+        # fullgraph=True fails on any graph break of the operators
+        for operator, inputs in [("forward_operator", x), ("adjoint_operator", y), ("gram", x)]:
+            fn = getattr(optics_layer, operator)
+            assert torch.allclose(torch.compile(fn, fullgraph=True)(inputs), fn(inputs), atol=1e-5)
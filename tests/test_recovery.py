@@ -67,4 +67,207 @@ def test_fista_algorithm(algo_params):
     error_algo    = torch.norm(x_true - x_hat)
 
     # Check if the error of the algorithm is smaller than the error of the trivial solution
-    assert error_algo < error_trivial, f"Error of the algorithm: {error_algo}, Error of the trivial solution: {error_trivial}"
\ No newline at end of file
+    assert error_algo < error_trivial, f"Error of the algorithm: {error_algo}, Error of the trivial solution: {error_trivial}"
+
+def test_fista_auto_step():
+    from colibri.optics import SPC
+
+    img_size = [1, 8, 8]
+    acquisition_model = SPC(img_size, n_measurements=32)
+    transform_dct = DCT2D()
+    fidelity = L2()
+
+    algo_params = {'max_iter': 20, 'lambda': 0.0, 'tol': 1e-3}
+    fista = Fista(fidelity, Sparsity(), acquisition_model, algo_params, transform_dct)
+
+    y = acquisition_model(torch.rand(1, *img_size))
+    x0 = torch.zeros(1, *img_size)
+    x_hat = fista(y, x0=x0)
+
+    # The step 1/L decreases the fidelity without diverging
+    assert fidelity(transform_dct.forward(x_hat), y, fista.H) < fidelity(x0, y, fista.H)
+
+@pytest.mark.parametrize("n_apertures", [1, 2])
+def test_fista_adjoint_grad(n_apertures):
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size, n_apertures=n_apertures)
+    fidelity = L2()
+
+    algo_params = {'max_iter': 20, 'lambda': 0.0, 'tol': 1e-3}
+    fista = Fista(fidelity, Sparsity(), acquisition_model, algo_params, DCT2D())
+    assert fista.H_adjoint is not None
+    assert Fista(fidelity, Sparsity(), acquisition_model, algo_params, DCT2D(norm=None)).H_adjoint is None
+
+    x = torch.rand(2, *img_size)
+    y = acquisition_model(torch.rand(2, *img_size))
+    grad = fidelity.grad(x, y, fista.H, H_adjoint=fista.H_adjoint)
+    grad_autograd = fidelity.grad(x.clone(), y, fista.H)
+
+    assert not grad.requires_grad
+    assert torch.allclose(grad, grad_autograd, atol=1e-5)
+
+def test_fista_half_precision():
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size)
+    x = torch.rand(2, *img_size)
+    y = acquisition_model(x).detach()
+
+    algo_params = {'max_iter': 50, 'lambda': 1e-3, 'tol': None}
+    transform = DCT2D()  # Shared by the runs that are compared
+    fista = Fista(L2(), Sparsity(), acquisition_model, algo_params, transform)
+    x_hat = fista(y, x0=torch.zeros_like(x))
+
+    # The half precision back-projections are cast to float32 before the DCT, which does not support half precision
+    acquisition_model.set_precision(torch.bfloat16)
+    assert fista.H_adjoint is not None
+    x_half = fista(y.bfloat16(), x0=torch.zeros_like(x))
+    assert x_half.dtype == torch.float32
+    assert torch.linalg.norm(x_half - x_hat) / torch.linalg.norm(x_hat) < 2e-2
+
+def test_fista_early_stopping():
+    from colibri.optics import SPC
+
+    img_size = [1, 8, 8]
+    acquisition_model = SPC(img_size, n_measurements=32)
+    tol = 1e-2
+
+    algo_params = {'max_iter': 100, 'lambda': 0.0, 'tol': tol, 'check_every': 5}
+    fista = Fista(L2(), Sparsity(), acquisition_model, algo_params, DCT2D())
+
+    y = acquisition_model(torch.rand(3, *img_size))
+    x_hat = fista(y, x0=torch.zeros(3, *img_size))
+    history = fista.history[:, 0]
+    objective = fista.history[:, 1]
+    assert x_hat.shape == (3, *img_size)
+    assert fista.history.shape[1:] == (2, 3) and fista.history.shape[0] <= 20
+    assert torch.equal(torch.isnan(objective), torch.isnan(history))
+
+    # Each sample is frozen at its first check below the tolerance
+    for b in range(3):
+        n_checks = int((~torch.isnan(history[:, b])).sum())
+        assert (history[:n_checks - 1, b] > tol).all()
+        assert torch.isnan(history[n_checks:, b]).all()
+        if n_checks < history.shape[0]:
+            assert history[n_checks - 1, b] <= tol
+        # Without regularization the objective is the fidelity, which FISTA decreases over the checks
+        assert objective[n_checks - 1, b] <= objective[0, b]
+
+    # Frozen samples are not modified by the iterations of the other samples
+    x_single = fista(y[:1], x0=torch.zeros(1, *img_size))
+    assert torch.allclose(x_hat[:1], x_single, atol=1e-5)
+
+@pytest.mark.parametrize("type", ["soft", "hard"])
+def test_sparsity_prox_out(type):
+    x = torch.randn(2, 4, 8, 8)
+    out = torch.empty_like(x)
+    result = Sparsity().prox(x, 0.5, type=type, out=out)
+
+    assert result.data_ptr() == out.data_ptr()
+    assert torch.equal(result, Sparsity().prox(x.clone(), 0.5, type=type).detach())
+
+def test_fista_inplace():
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size)
+    transform = DCT2D()  # Shared by the runs that are compared
+    algo_params = {'max_iter': 30, 'lambda': 1e-3, 'tol': None}
+
+    y = acquisition_model(torch.rand(2, *img_size))
+    x0 = torch.zeros(2, *img_size)
+    x_hat = Fista(L2(), Sparsity(), acquisition_model, algo_params, transform)(y, x0=x0)
+    x_inplace = Fista(L2(), Sparsity(), acquisition_model, dict(algo_params, inplace=True), transform)(y, x0=x0)
+
+    assert torch.allclose(x_inplace, x_hat, atol=1e-5)
+    assert torch.equal(x0, torch.zeros_like(x0))
+
+@pytest.mark.parametrize("inplace", [False, True])
+def test_fista_regularization_path(inplace):
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size)
+    transform = DCT2D()  # Shared by the runs that are compared
+    lambdas = [1e-3, 1e-1, 1e-2]
+    algo_params = {'max_iter': 30, 'lambda': lambdas, 'tol': None, 'inplace': inplace}
+
+    y = acquisition_model(torch.rand(2, *img_size))
+    x0 = torch.zeros(2, *img_size)
+    fista = Fista(L2(), Sparsity(), acquisition_model, algo_params, transform)
+    x_path = fista(y, x0=x0)
+
+    assert x_path.shape == (3, 2, *img_size)
+    assert torch.allclose(fista.lambdas, torch.tensor(sorted(lambdas, reverse=True)))
+
+    # Each solution of the path is the solution of its own run
+    for p, _lambda in enumerate(sorted(lambdas, reverse=True)):
+        x_hat = Fista(L2(), Sparsity(), acquisition_model, dict(algo_params, **{'lambda': _lambda}), transform)(y, x0=x0)
+        assert torch.allclose(x_path[p], x_hat, atol=1e-5)
+
+@pytest.mark.parametrize("restart", ["gradient", "function"])
+def test_fista_restart(restart):
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size)
+    transform = DCT2D()  # Shared by the runs that are compared
+    fidelity = L2()
+    algo_params = {'max_iter': 30, 'lambda': 1e-3, 'tol': None, 'restart': restart}
+
+    y = acquisition_model(torch.rand(2, *img_size))
+    x0 = torch.zeros(2, *img_size)
+    fista = Fista(fidelity, Sparsity(), acquisition_model, algo_params, transform)
+    x_hat = fista(y, x0=x0)
+    x_inplace = Fista(fidelity, Sparsity(), acquisition_model, dict(algo_params, inplace=True), transform)(y, x0=x0)
+
+    assert torch.allclose(x_inplace, x_hat, atol=1e-5)
+    assert fidelity(transform.forward(x_hat), y, fista.H) < fidelity(x0, y, fista.H)
+
+def test_fista_backtracking():
+    from colibri.optics import SD_CASSI
+
+    img_size = [4, 8, 8]
+    acquisition_model = SD_CASSI(img_size)
+    fidelity = L2()
+    algo_params = {'max_iter': 20, 'alpha': 10.0, 'lambda': 1e-3, 'tol': None, 'backtracking': True}
+
+    y = acquisition_model(torch.rand(2, *img_size))
+    x0 = torch.zeros(2, *img_size)
+    fista = Fista(fidelity, Sparsity(), acquisition_model, algo_params, DCT2D())
+    x_hat = fista(y, x0=x0)
+
+    # The accepted step is at most a factor eta below 1/L
+    lipschitz = acquisition_model.operator_norm(DCT2D()) ** 2
+    assert 1 / 10.0 < fista.lipschitz <= 2 * lipschitz * 1.01
+    assert fidelity(DCT2D().forward(x_hat), y, fista.H) < fidelity(x0, y, fista.H)
+
+    # The next call starts from the accepted estimate
+    accepted = fista.lipschitz
+    fista(y, x0=x0)
+    assert fista.lipschitz >= accepted
+
+    # The threshold follows the step size, so the calls solve the same problem
+    fista = Fista(fidelity, Sparsity(), acquisition_model, dict(algo_params, max_iter=300, **{'lambda': 1e-1}), DCT2D())
+    assert torch.allclose(fista(y, x0=x0), fista(y, x0=x0), atol=1e-4)
+
+    # Near the solution the estimate does not grow on rounding noise, and the next call converges as a fresh solver
+    fista = Fista(fidelity, Sparsity(), acquisition_model, dict(algo_params, max_iter=500), DCT2D())
+    fista(y, x0=x0)
+    assert fista.lipschitz <= lipschitz * 1.01
+    fresh = Fista(fidelity, Sparsity(), acquisition_model, dict(algo_params, max_iter=500), DCT2D())
+    assert torch.allclose(fista(y, x0=x0), fresh(y, x0=x0), atol=1e-5)
+
+    # The estimate is discarded when the optics change
+    with torch.no_grad():
+        acquisition_model.learnable_optics.mul_(2)
+    assert fista.lipschitz is None
+
+    # The estimate is kept by the solver for trainable optics
+    acquisition_model = SD_CASSI(img_size, trainable=True)
+    fista = Fista(fidelity, Sparsity(), acquisition_model, algo_params, DCT2D())
+    fista(acquisition_model(torch.rand(2, *img_size)).detach(), x0=x0)
+    assert fista.lipschitz is not None